@@ -0,0 +1,121 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Content addressed cache of bob build results
+'''
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from conary import versions
+from conary.deps import deps
+
+
+logger = logging.getLogger(__name__)
+
+# Macros that change every run without changing what gets built
+VOLATILE_MACROS = ('start_time',)
+
+
+class BuildCache(object):
+    '''
+    B{BuildCache}
+    Remember which troves a build of a bob plan produced.
+    Entries are keyed by a hash of the plan file, its resolved macros
+    and the source commit, one json file per key so concurrent runs
+    on different branches can share the directory.
+    @param path: directory holding the cache entries
+    @type path: C{string}
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def planDigest(bobplan, macros):
+        '''
+        hash the contents of a plan file and its resolved macros
+        @param bobplan: path to the plan
+        @param macros: macros of the plan
+        @return: hex digest or None if the macros can not be resolved
+        '''
+        digest = hashlib.sha1()
+        with open(bobplan, 'rb') as fobj:
+            digest.update(fobj.read())
+        try:
+            for key in sorted(macros.keys()):
+                if key in VOLATILE_MACROS:
+                    continue
+                digest.update('\0%s=%s' % (key, macros[key]))
+        except (KeyError, ValueError, TypeError), err:
+            logger.debug('Not caching %s, unresolved macros : %s' %
+                         (bobplan, err))
+            return None
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(planDigest, commit):
+        '''
+        @return: cache key of a plan digest built from commit
+                 or None if either is unknown
+        '''
+        if not planDigest or not commit:
+            return None
+        return hashlib.sha1('%s\0%s' % (planDigest, commit)).hexdigest()
+
+    def _entryPath(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, key):
+        '''
+        @return: list of (name, version, flavor) trove tuples built
+                 for key or None on a miss
+        '''
+        path = self._entryPath(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as fobj:
+                entry = json.load(fobj)
+            return [ (str(name), versions.ThawVersion(str(version)),
+                        deps.ThawFlavor(str(flavor)))
+                        for name, version, flavor in entry['troves'] ]
+        except (IOError, ValueError, KeyError), err:
+            logger.warn('Ignoring bad build cache entry %s : %s' % (path, err))
+            return None
+
+    def put(self, key, troves):
+        '''
+        record the trove tuples a build produced
+        @param key: cache key
+        @param troves: list of (name, version, flavor)
+        '''
+        path = self._entryPath(key)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        entry = {'time': time.time(),
+                 'troves': [ (name, version.freeze(), flavor.freeze())
+                                for name, version, flavor in troves ],
+                }
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + key)
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(entry, fobj)
+        os.rename(tmp, path)
@@ -18,16 +18,33 @@
 Build actions for packages
 '''
 
+import gzip
 import logging
 import os
+import re
+import signal
 import subprocess
+import threading
+import time
 
 from factory import ConaryClientFactory as _ccf
+from . import buildcache
+from . import buildlog
 from . import config
+from . import history
+from . import scheduler
 
 
 logger = logging.getLogger(__name__)
 
+_BUILDREQS = re.compile(r'buildRequires\s*\+?=\s*\[(.*?)\]', re.S)
+_QUOTED = re.compile(r'''['"]([^'"]+)['"]''')
+
+# Return code of a bob run that was stopped for taking too long
+TIMEOUT_RC = 124
+# Return code of a bob run that was stopped because the build was cancelled
+CANCEL_RC = 130
+
 
 class Builder(object):
     '''
@@ -36,9 +53,14 @@ class Builder(object):
     @param packageset: Set of package objects to build
     @keyword cfg: cfg object
     @keyword test: toggle test run
+    @keyword jobs: number of bob plans to build at once
+    @keyword explain: print the predicted schedule instead of building
+    @keyword journal: C{Journal} to record build outcomes in
+                      and to resume from
     '''
 
-    def __init__(self, packageset, cfg=None, test=False):
+    def __init__(self, packageset, cfg=None, test=False, jobs=None,
+                    explain=False, journal=None):
         self.packageset = packageset
         self._cfg = cfg
         if not self._cfg:
@@ -49,6 +71,16 @@ class Builder(object):
             logger.warn('testOnly set in config file ignoring commandline')
             self.test = self._cfg.testOnly
 
+        self.jobs = jobs or self._cfg.maxParallelBuilds
+        self.explain = explain
+        self.journal = journal
+        self._stopAt = None
+        self._procs = set()
+        # bob plan to the wall time of its last attempt, retries
+        # and the backoff before them are left out of the history
+        self._durations = {}
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
         self.bobexec = self._cfg.bobExec
         self.logfile = self._cfg.logFile
         self.tmpdir = self._cfg.tmpDir
@@ -60,6 +92,15 @@ class Builder(object):
         self.products = self.packageset[self._cfg.productsDir]
         self.external = self.packageset[self._cfg.externalDir]
         self._cclient = None
+        self.history = history.BuildHistory(
+                            self._cachePath(self._cfg.buildHistoryFile))
+        self.logs = buildlog.BuildLogs(self._cfg.buildLogDir,
+                                       keep=self._cfg.buildLogKeep,
+                                       compress=self._cfg.buildLogCompress)
+        self.buildCache = None
+        if self._cfg.buildCache:
+            self.buildCache = buildcache.BuildCache(
+                            self._cachePath(self._cfg.buildCacheDir))
 
     def getDefaultConfig(self):
         '''get default cfg object for builder'''
@@ -68,6 +109,12 @@ class Builder(object):
         self._cfg.read()
 
 
+    def _cachePath(self, path):
+        '''return path relative to the cache directory unless absolute'''
+        if os.path.isabs(path):
+            return path
+        return os.path.join(self._cfg.cacheDir, path)
+
     def _get_client(self, force=False):
         '''return a fresh conary client'''
         if self._cclient is None or force:
@@ -78,7 +125,8 @@ class Builder(object):
     conaryClient = property(_get_client)
 
 
-    def _build(self, path, name=None, version=None, tag=None):
+    def _build(self, path, name=None, version=None, tag=None,
+                deadline=None):
         '''
         Wrapper for bob the builder
 
@@ -93,6 +141,8 @@ class Builder(object):
         @type version: C{string}
         @param tag: string representation of tag from git repo (optional)
         @type: C{string}
+        @param deadline: time to stop the build by (optional)
+        @type deadline: C{float}
         '''
         cmd = [self.bobexec, path]
 
@@ -116,27 +166,150 @@ class Builder(object):
         if self.test:
             return 0, ' '.join(cmd)
 
-        proc = subprocess.Popen(cmd)
-        proc.communicate()
-        return proc.returncode, ' '.join(cmd)
-
-
-    def updatePkgVersion(self, pkg):
+        log = self.logs.open(history.BuildHistory.key(path))
+        logger.info('Writing bob output for %s to %s' % (path, log.path))
+        stdout = log.start(cmd)
+        rc = None
+        try:
+            # own process group so a stuck build can be killed
+            # along with everything it started
+            proc = subprocess.Popen(cmd, stdout=stdout,
+                                    stderr=subprocess.STDOUT,
+                                    preexec_fn=os.setsid)
+            log.attach(proc)
+            rc = self._wait(proc, deadline)
+        finally:
+            log.close(rc)
+        if rc == TIMEOUT_RC:
+            return rc, '%s (timed out)' % ' '.join(cmd)
+        if rc == CANCEL_RC:
+            return rc, '%s (cancelled)' % ' '.join(cmd)
+        return rc, ' '.join(cmd)
+
+    def _wait(self, proc, deadline=None):
         '''
-        B{updatePkgVersion}
-        Tries to find conary version of a package
-        @param pkg: package object
-        @return: updated package object
+        wait for a bob process, killing it once deadline passes
+        or the build is cancelled
+        @return: return code of the process, TIMEOUT_RC or CANCEL_RC
         '''
-        revision = None
-        version = None
-        query = { pkg.target: { pkg.label: None, },}
-        latest = self.conaryClient.repos.getTroveLeavesByLabel(query)
-        if latest:
-            logger.debug('Latest Version : %s' % str(latest))
+        self._lock.acquire()
+        self._procs.add(proc)
+        self._lock.release()
+        try:
+            while proc.poll() is None:
+                if deadline and time.time() > deadline:
+                    logger.error('bob pid %s timed out, stopping it' % 
+                                 proc.pid)
+                    self._terminate(proc)
+                    return TIMEOUT_RC
+                if self._cancelled.isSet():
+                    # bob may outlive the kill, there is no
+                    # return code to give then
+                    self._terminate(proc)
+                    return CANCEL_RC
+                time.sleep(0.5)
+            return proc.returncode
+        finally:
+            self._lock.acquire()
+            self._procs.discard(proc)
+            self._lock.release()
+
+    @staticmethod
+    def _terminate(proc, grace=10):
+        '''
+        stop the process group of proc, politely first
+        '''
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except OSError:
+                return
+            end = time.time() + grace
+            while time.time() < end:
+                if proc.poll() is not None:
+                    return
+                time.sleep(0.2)
+        logger.error('bob pid %s did not exit, abandoning it' % proc.pid)
+
+    def cancel(self):
+        '''stop every running bob process and any pending retries'''
+        self._cancelled.set()
+        self._lock.acquire()
+        procs = list(self._procs)
+        self._lock.release()
+        for proc in procs:
+            logger.warn('Stopping bob pid %s' % proc.pid)
+            self._terminate(proc)
+
+    def _deadline(self, key):
+        '''
+        @return: time a build of plan key has to finish by or None
+        '''
+        timeout = self._cfg.planTimeouts.get(key,
+                    self._cfg.planTimeouts.get(os.path.basename(key),
+                        self._cfg.buildTimeout))
+        deadlines = [ x for x in (timeout and time.time() + timeout,
+                                  self._stopAt) if x ]
+        if not deadlines:
+            return None
+        return min(deadlines)
+
+    def _isTransient(self, key):
+        '''
+        check the end of the last log of plan key for errors
+        listed in transientErrors
+        '''
+        path = self.logs.get(key).path
+        if not os.path.exists(path):
+            return False
+        opener = gzip.open if path.endswith('.gz') else open
+        tail = ''
+        fobj = opener(path, 'rb')
+        try:
+            while True:
+                data = fobj.read(65536)
+                if not data:
+                    break
+                tail = (tail + data)[-65536:]
+        finally:
+            fobj.close()
+        for pattern in self._cfg.transientErrors:
+            if re.search(pattern, tail):
+                logger.debug('%s matched transient error %r' % 
+                             (key, pattern))
+                return True
+        return False
+
+
+    def updatePkgVersions(self, pkgs):
+        '''
+        B{updatePkgVersions}
+        Tries to find conary versions of a list of packages
+        Only makes one query to the repository, the client
+        splits it into one call per repository server
+        @param pkgs: list of package objects
+        @return: list of updated package objects
+        '''
+        query = {}
+        for pkg in pkgs:
+            query.setdefault(pkg.target, {}).update({ pkg.label: None, })
+        if not query:
+            return pkgs
+        logger.debug('Refreshing conary versions of %s packages' % len(pkgs))
+        latestTroves = self.conaryClient.repos.getTroveLeavesByLabel(query)
+        for pkg in pkgs:
+            latest = latestTroves.get(pkg.target)
+            if not latest:
+                continue
+            if len(query[pkg.target]) > 1:
+                # Same target on more than one label in this wave
+                latest = dict([ (x, y) for x, y in latest.iteritems()
+                                    if x.trailingLabel() == pkg.label ])
+                if not latest:
+                    continue
             logger.debug('%s found on %s' % (pkg.target, pkg.label))
-            versions = latest[pkg.target]
-            version = max(versions)
+            version = max(latest)
+            logger.debug('Latest Version : %s' % version.asString())
             revision = version.trailingRevision().version
             logger.debug('Found revision %s of %s' % 
                             (str(revision),pkg.target))
@@ -146,7 +319,16 @@ class Builder(object):
                             'version': version,
                             'latest': latest,
                             })
-        return pkg
+        return pkgs
+
+    def updatePkgVersion(self, pkg):
+        '''
+        B{updatePkgVersion}
+        Tries to find conary version of a package
+        @param pkg: package object
+        @return: updated package object
+        '''
+        return self.updatePkgVersions([pkg])[0]
 
     def handler(self, packages):
         '''
@@ -166,53 +348,386 @@ class Builder(object):
         return tobuild
 
 
-    def build(self, packages):
+    def _plans(self, packages):
+        '''
+        Group the packages flagged for build by bob plan.
+        A plan only has to be built once no matter how many
+        targets it produces
+        @param packages: set of package objects
+        @return: list of (bobplan, [(name, pkg), ...]) in build order
+        @rtype: C{list}
+        '''
+        tobuild = self.handler(packages)
+        plans = {}
+        order = []
+        for name, pkgs in packages.items():
+            for pkg in pkgs:
+                if pkg in tobuild:
+                    if pkg.bobplan not in plans:
+                        order.append(pkg.bobplan)
+                    plans.setdefault(pkg.bobplan, []).append((name, pkg))
+        return [ (x, plans[x]) for x in order ]
+
+    def _recipeRequires(self, pkg):
+        '''
+        Read the buildRequires of the recipes in the sourceTree of a package
+        @param pkg: package object
+        @return: names of the packages required to build pkg
+        @rtype: C{set}
+        '''
+        requires = set()
+        if not pkg.sourceTree or not pkg.controllers:
+            return requires
+        scm, subpath = (pkg.sourceTree.split(None, 1) + [''])[:2]
+        ctrlr = pkg.controllers.get(scm)
+        if not ctrlr:
+            return requires
+        try:
+            ctrlr.updatecache()
+            files = ctrlr.ctrl.getRecipe(subpath.strip())
+        except Exception, err:
+            logger.warn('Unable to read recipes for %s : %s' % (pkg.name, err))
+            return requires
+        for fn, blob in files.iteritems():
+            if not fn.endswith('.recipe'):
+                continue
+            for reqs in _BUILDREQS.findall(blob):
+                for req in _QUOTED.findall(reqs):
+                    requires.add(req.split('=')[0].split('[')[0].split(':')[0])
+        logger.debug('%s buildRequires %s' % (pkg.name, sorted(requires)))
+        return requires
+
+    def _dependencies(self, plans):
+        '''
+        Work out which plans have to be built before which.
+        Edges come from the after list of the plan targets and,
+        when recipeDependencies is set, the buildRequires of the recipes.
+        Only plans that are being built are taken into account
+        @param plans: list of (bobplan, [(name, pkg), ...])
+        @return: dict of bobplan to the bobplans it has to wait for
+        @rtype: C{dict}
+        '''
+        targets = {}
+        for bobplan, members in plans:
+            for _, pkg in members:
+                targets[pkg.name] = bobplan
+        deps = {}
+        for bobplan, members in plans:
+            after = set()
+            for _, pkg in members:
+                after.update(pkg.after or [])
+                if self._cfg.recipeDependencies:
+                    after.update(self._recipeRequires(pkg))
+            deps[bobplan] = set([ targets[x] for x in after 
+                                    if x in targets ]) - set([bobplan])
+            if deps[bobplan]:
+                logger.debug('%s builds after %s' % (bobplan, 
+                                                sorted(deps[bobplan])))
+        return deps
+
+    def _promote(self, troves, label):
+        '''
+        Sibling clone cached troves built on another label to label
+        @param troves: list of (name, version, flavor)
+        @param label: target label
+        @return: list of promoted trove tuples or None
+        '''
+        labelMap = dict([ (x[1].trailingLabel(), label) for x in troves ])
+        if self.test:
+            logger.info('Would promote %s to %s' % 
+                            ([ x[0] for x in troves ], label))
+            return None
+        ok, cs = self.conaryClient.createSiblingCloneChangeSet(labelMap,
+                                            troves, cloneSources=True)
+        if not ok:
+            return None
+        self.conaryClient.repos.commitChangeSet(cs)
+        names = set([ x[0] for x in troves ])
+        return [ (x.getName(), x.getNewVersion(), x.getNewFlavor())
+                    for x in cs.iterNewTroveList() if x.getName() in names ]
+
+    def _reuse(self, members):
+        '''
+        Try to satisfy a plan from the build cache instead of bob.
+        Troves already on the target label are reused, troves built
+        on another label are promoted when buildCachePromote is set.
+        Plans with a target forced on the command line are always built
+        @param members: list of (name, pkg) built by the plan
+        @return: True if the plan does not have to be built
+        '''
+        pkg = members[0][1]
+        key = buildcache.BuildCache.key(pkg.planDigest, pkg.commit)
+        if not self.buildCache or not key:
+            return False
+        if [ x for _, x in members if x.forced ]:
+            logger.info('%s was forced, not using the build cache' %
+                        pkg.bobplan)
+            return False
+        troves = self.buildCache.get(key)
+        if not troves:
+            return False
+        names = set([ x[0] for x in troves ])
+        if [ x for _, x in members if x.target not in names ]:
+            return False
+        try:
+            if not [ x for x in troves 
+                        if x[1].trailingLabel() != pkg.label ]:
+                present = self.conaryClient.repos.hasTroves(troves)
+                if isinstance(present, dict):
+                    present = present.values()
+                if not min(present):
+                    return False
+                how = 'Reused'
+            else:
+                if not self._cfg.buildCachePromote:
+                    logger.info('%s was built on another label, not '
+                                'promoting' % pkg.bobplan)
+                    return False
+                troves = self._promote(troves, pkg.label)
+                if not troves:
+                    return False
+                how = 'Promoted'
+        except Exception, err:
+            logger.warn('Build cache lookup for %s failed : %s' % 
+                                                        (pkg.bobplan, err))
+            return False
+        for _, member in members:
+            tups = [ x for x in troves if x[0] == member.target ]
+            version = max([ x[1] for x in tups ])
+            latest = {}
+            for _, ver, flv in tups:
+                if ver == version:
+                    latest.setdefault(ver, []).append(flv)
+            member.update({'revision': version.trailingRevision().version,
+                           'version': version,
+                           'latest': latest,
+                           'log': '%s: %s=%s' % (how, member.target,
+                                                 version.asString()),
+                           })
+        logger.info('%s cached build of %s' % (how, pkg.bobplan))
+        return True
+
+    def _record(self, members):
+        '''
+        Save the troves built from a plan in the build cache
+        @param members: list of (name, pkg) built by the plan
+        '''
+        pkg = members[0][1]
+        key = buildcache.BuildCache.key(pkg.planDigest, pkg.commit)
+        if not self.buildCache or not key or self.test:
+            return
+        troves = []
+        for _, member in members:
+            # only cache what we know came from this commit
+            if not member.revision or not member.latest or not \
+                    pkg.commit.startswith(member.revision.split('.')[-1]):
+                return
+            for flv in member.latest.get(member.version, []):
+                troves.append((member.target, member.version, flv))
+        if troves:
+            self.buildCache.put(key, troves)
+
+    def _summary(self, key, members, status, job=None, rc=None,
+                    blocked=None):
+        '''
+        @return: summary record of a plan for the build summary
+        @rtype: C{dict}
+        '''
+        record = {'plan': key,
+                  'packages': sorted([ x.name for _, x in members ]),
+                  'commit': members[0][1].commit,
+                  'status': status,
+                  'rc': rc,
+                  'start': None,
+                  'end': None,
+                  'duration': None,
+                  'log': None,
+                  'blocked': blocked,
+                 }
+        if job:
+            record.update({'start': job.start,
+                           'end': job.end,
+                           'duration': job.duration,
+                           'log': self.logs.get(key).path,
+                          })
+        return record
+
+    def _buildPlan(self, pkg):
+        '''
+        Build the plan of a package with its version and tag
+        @param pkg: package object
+        @return: return code and command line of bob
+        '''
+        # FIXME
+        # For now this is the version convention
+        # TODO 
+        # Add revision.txt  info to trove source metadata
+        version = None
+        if pkg.commit:
+            version = '%s.%s' % (pkg.branch, pkg.commit[:12])
+        key = history.BuildHistory.key(pkg.bobplan)
+        attempt = 0
+        while True:
+            start = time.time()
+            rc, cmd = self._build(  path=pkg.bobplan, 
+                                    name=pkg.name,
+                                    version=version, 
+                                    tag=pkg.tag,
+                                    deadline=self._deadline(key),
+                                )
+            self._lock.acquire()
+            self._durations[pkg.bobplan] = time.time() - start
+            self._lock.release()
+            if (rc == 0 or rc == TIMEOUT_RC or self._cancelled.isSet()
+                    or attempt >= self._cfg.buildRetries
+                    or not self._isTransient(key)):
+                return rc, cmd
+            delay = self._cfg.buildRetryDelay * 2 ** attempt
+            attempt += 1
+            logger.warn('%s failed with a transient error, retry %s of %s '
+                        'in %ss' % (pkg.bobplan, attempt,
+                                    self._cfg.buildRetries, delay))
+            self._cancelled.wait(delay)
+
+    def build(self, packages, section='build'):
         '''
         B{Build}
  
         checks a set of package objects using handler
         then passes package objects to _build to be built
+        up to self.jobs plans are built at the same time
+        in the order given by their dependencies, plans heading
+        the longest chain of builds (by past build times) go first
         @param packages: set of package objects
+        @keyword section: name of the build summary to write
         @return: updated set of package objects
         @rtype: C{set}
         '''
-        tobuild = self.handler(packages)
         built_packages = []
         failed_packages = []
+        blocked_packages = []
         seen_plans = []
         skipped = []
-        for name, pkgs in packages.items():
-            for pkg in pkgs:
-                if pkg in tobuild:
-                    # lets not build pkgs more than once
-                    if pkg.bobplan not in seen_plans:
-                        seen_plans.append(pkg.bobplan)
+        cached = []
+        resumed = []
+        refresh = []
+        plans = {}
+        built_plans = []
+        records = []
+        journaled = {}
+        if self.journal:
+            journaled = self.journal.built()
+        default = self.history.average() or 1
+        self._stopAt = None
+        if self._cfg.totalBuildTimeout:
+            self._stopAt = time.time() + self._cfg.totalBuildTimeout
+        pool = scheduler.BuildScheduler(self.jobs,
+                    failed=lambda job: job.result[0] != 0,
+                    weight=lambda job: self.history.estimate(job.name) 
+                                            or default,
+                    deadline=self._stopAt)
+        ordered = []
+        for bobplan, members in self._plans(packages):
+            key = history.BuildHistory.key(bobplan)
+            if key in journaled and journaled[key] == members[0][1].commit:
+                # Built before the previous run died
+                resumed.append(bobplan)
+                records.append(self._summary(key, members, 'resumed'))
+                for name, pkg in members:
+                    pkg.log = 'Resumed: built by the interrupted run'
+                    refresh.append(pkg)
+                    packages.setdefault(name, set()).add(pkg)
+                continue
+            # Asking the build cache may promote troves, the schedule
+            # only predicts what bob would be asked to build
+            if not self.explain and self._reuse(members):
+                cached.append(bobplan)
+                records.append(self._summary(key, members, 'cached'))
+                for name, pkg in members:
+                    packages.setdefault(name, set()).add(pkg)
+                continue
+            ordered.append((bobplan, members))
+            seen_plans.append(bobplan)
+            plans[bobplan] = members
+            pool.add(bobplan, self._buildPlan, members[0][1])
+        for bobplan, after in self._dependencies(ordered).iteritems():
+            pool.depend(bobplan, after)
+
+        if len(seen_plans) > 1 and pool.jobs > 1:
+            logger.info('Building %s plans %s at a time' % 
+                            (len(seen_plans), pool.jobs))
+
+        if self.explain:
+            if seen_plans:
+                for line in pool.explain():
+                    print line
+            else:
+                print 'Nothing to build'
+            return packages
+
+        def finished(job):
+            '''collect the results of a plan as soon as bob exits'''
+            key = history.BuildHistory.key(job.name)
+            if job.status == scheduler.SKIPPED:
+                records.append(self._summary(key, plans[job.name], job.status,
+                                             blocked=job.blocked))
+                for name, pkg in plans[job.name]:
+                    if job.blocked == scheduler.DEADLINE:
+                        pkg.log = 'Skipped: totalBuildTimeout reached'
                     else:
-                        skipped.append(pkg.name)
-                        pkg.log = 'Built in %s' % pkg.bobplan
-                        pkg = self.updatePkgVersion(pkg)
-                        packages.setdefault(pkg.name, set()).add(pkg)
-                        continue
-                    # FIXME
-                    # For now this is the version convention
-                    # TODO 
-                    # Add revision.txt  info to trove source metadata
-                    version = None
-                    if pkg.commit:
-                        version = '%s.%s' % (pkg.branch, pkg.commit[:12])
-                    rc, cmd = self._build(  path=pkg.bobplan, 
-                                            name=pkg.name,
-                                            version=version, 
-                                            tag=pkg.tag,
-                                    )
-
-                    pkg.log = ('Failed: %s' if rc else 'Success: %s') % cmd
-                    if rc:
+                        pkg.log = 'Skipped: %s failed' % job.blocked
+                    blocked_packages.append(pkg)
+                    packages.setdefault(name, set()).add(pkg)
+                return
+            rc, cmd = job.result or (1, '%s (%s)' % (job.name, job.error))
+            records.append(self._summary(key, plans[job.name], job.status,
+                                         job=job, rc=rc))
+            if self.journal:
+                self.journal.build(key, plans[job.name][0][1].commit, rc)
+            if job.status == scheduler.DONE and not self.test:
+                self.history.record(job.name,
+                        self._durations.get(job.name, job.duration))
+            for idx, (name, pkg) in enumerate(plans[job.name]):
+                if idx:
+                    # lets not build pkgs more than once
+                    skipped.append(pkg.name)
+                    pkg.log = 'Built in %s' % pkg.bobplan
+                    refresh.append(pkg)
+                else:
+                    pkg.log = ('Failed: %s' if rc != 0 else 'Success: %s') % cmd
+                    if rc != 0:
                         failed_packages.append(pkg)
                     else:
-                        pkg = self.updatePkgVersion(pkg)
+                        refresh.append(pkg)
                         built_packages.append(pkg)
+                        built_plans.append(job.name)
                 packages.setdefault(name, set()).add(pkg)
+
+        try:
+            pool.run(finished)
+        except KeyboardInterrupt:
+            logger.error('Interrupted, stopping running builds')
+            self.cancel()
+            raise
+        if not self.test:
+            self.history.save()
+
+        if records and not self.test:
+            logger.info('Build summary written to %s' % 
+                        self.logs.writeSummary(section, records))
+
+        # One version refresh for the whole wave of builds
+        self.updatePkgVersions(refresh)
+        for bobplan in built_plans:
+            self._record(plans[bobplan])
+
+        if cached:
+            logger.info('List of plans taken from the build cache: %s' % 
+                        cached)
+
+        if resumed:
+            logger.info('List of plans already built before resuming: %s' % 
+                        resumed)
         
         if self.test:
             for _, pkgs in packages.items():
@@ -228,6 +743,11 @@ class Builder(object):
             logger.warn('List of failed package builds: %s' %
                         [pkg.name for pkg in failed_packages])
 
+        if blocked_packages:
+            logger.warn('List of packages skipped after a failed '
+                        'dependency: %s' %
+                        [pkg.name for pkg in blocked_packages])
+
         return packages
 
     def buildProjects(self):
@@ -235,7 +755,7 @@ class Builder(object):
         Build Projects from the packageset
         '''
         # TODO Finish buildGroup
-        projects = self.build(self.projects)
+        projects = self.build(self.projects, self._cfg.projectsDir)
         self.packageset[self._cfg.projectsDir].update(projects)
         return self.packageset
 
@@ -243,7 +763,7 @@ class Builder(object):
         '''
         Build Products from the packageset
         '''
-        products = self.build(self.products)
+        products = self.build(self.products, self._cfg.productsDir)
         self.packageset[self._cfg.productsDir].update(products)
         return self.packageset
 
@@ -0,0 +1,172 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Per plan log files for bob output
+'''
+
+import errno
+import gzip
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK = 65536
+
+
+class BuildLog(object):
+    '''
+    B{BuildLog}
+    Log file a single bob run writes its stdout and stderr to.
+    Plain logs are handed straight to the child process,
+    compressed logs are streamed through gzip by a pump thread
+    so the output is never held in memory.
+    @param path: path of the log without compression suffix
+    @type path: C{string}
+    @keyword compress: gzip the log
+    @type compress: C{bool}
+    '''
+
+    def __init__(self, path, compress=False):
+        self.stem = path
+        self.compress = compress
+        self.suffix = '.gz' if compress else ''
+        self._fobj = None
+        self._pump = None
+
+    @property
+    def path(self):
+        '''path of the current log'''
+        return self._name(0)
+
+    def _name(self, idx):
+        if idx:
+            return '%s.%d%s' % (self.stem, idx, self.suffix)
+        return self.stem + self.suffix
+
+    def rotate(self, keep):
+        '''
+        shift older logs out of the way keeping at most keep of them
+        '''
+        for idx in range(keep - 1, 0, -1):
+            src = self._name(idx - 1)
+            if os.path.exists(src):
+                os.rename(src, self._name(idx))
+
+    def start(self, cmd):
+        '''
+        open the log and write a header for cmd
+        @return: value to pass as stdout to C{subprocess.Popen}
+        '''
+        if self.compress:
+            self._fobj = gzip.open(self.path, 'wb')
+        else:
+            self._fobj = open(self.path, 'wb')
+        self._fobj.write('# %s\n# started %s\n' % (' '.join(cmd),
+                                                   time.ctime()))
+        self._fobj.flush()
+        if self.compress:
+            return subprocess.PIPE
+        return self._fobj
+
+    def _copy(self, src):
+        '''pump thread body'''
+        fd = src.fileno()
+        while True:
+            data = os.read(fd, CHUNK)
+            if not data:
+                break
+            self._fobj.write(data)
+        src.close()
+
+    def attach(self, proc):
+        '''start streaming the output of proc into the log'''
+        if not self.compress:
+            return
+        self._pump = threading.Thread(target=self._copy, args=(proc.stdout,),
+                                      name='log-%s' % self.stem)
+        self._pump.daemon = True
+        self._pump.start()
+
+    def close(self, rc=None):
+        '''wait for the output to drain and close the log'''
+        if self._pump:
+            self._pump.join()
+            self._pump = None
+        if self._fobj:
+            self._fobj.write('\n# finished %s with status %s\n' %
+                             (time.ctime(), rc))
+            self._fobj.close()
+            self._fobj = None
+
+
+class BuildLogs(object):
+    '''
+    B{BuildLogs}
+    Directory of rotating per plan build logs and build summaries
+    @param directory: where logs are kept
+    @keyword keep: number of logs kept per plan
+    @keyword compress: gzip the logs
+    '''
+
+    def __init__(self, directory, keep=5, compress=False):
+        self.directory = directory
+        self.keep = max(1, keep)
+        self.compress = compress
+
+    def get(self, key):
+        '''
+        @param key: section/filename of a plan
+        @return: C{BuildLog} for key, not yet opened
+        '''
+        return BuildLog(os.path.join(self.directory, key + '.log'),
+                        self.compress)
+
+    def open(self, key):
+        '''
+        @return: C{BuildLog} for key with older logs rotated
+        '''
+        log = self.get(key)
+        try:
+            os.makedirs(os.path.dirname(log.path))
+        except OSError, err:
+            # another build got there first
+            if err.errno != errno.EEXIST:
+                raise
+        log.rotate(self.keep)
+        return log
+
+    def writeSummary(self, name, records):
+        '''
+        write the machine readable summary of a build wave
+        @param name: name of the wave (projects, products)
+        @param records: list of dicts, one per plan
+        @return: path to the summary
+        '''
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, '%s-summary.json' % name)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.summary')
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(records, fobj, indent=1, sort_keys=True)
+        os.rename(tmp, path)
+        return path
@@ -0,0 +1,263 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Size and age bounded eviction for the cache and plan directories
+'''
+
+import errno
+import logging
+import os
+import shutil
+import time
+
+from .scm import archive
+from .scm import cachelock
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+MB = 1024 * 1024
+# Directories of the cache that are not entries of their own
+PLANS = 'plans'
+OBJECTS = 'git-objects'
+RESERVED = (archive.ARCHIVE_DIR, PLANS, OBJECTS, 'wms-poll')
+# Subdirectories the scm layer keeps a repository cache in
+REPO_KINDS = ('git', 'hg', 'local')
+
+
+def touch(path):
+    '''record a use of the cache entry at path'''
+    try:
+        os.utime(path, None)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def diskUsage(path):
+    '''@return: bytes used by the files under path'''
+    if not os.path.isdir(path):
+        try:
+            return os.lstat(path).st_size
+        except OSError:
+            return 0
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+class CacheEntry(object):
+    '''
+    One directory the cache manager can evict as a whole
+    @param area: name of the area the entry belongs to
+    @param path: path to the entry
+    @keyword locked: the entry is a repository cache guarded
+                     by a C{CacheLock}
+    '''
+
+    def __init__(self, area, path, locked=False):
+        self.area = area
+        self.path = path
+        self.locked = locked
+        self.size = diskUsage(path)
+        try:
+            self.atime = os.stat(path).st_mtime
+        except OSError:
+            self.atime = 0
+
+    @property
+    def age(self):
+        '''seconds since the entry was last used'''
+        return max(0, time.time() - self.atime)
+
+
+class CacheManager(object):
+    '''
+    B{CacheManager}
+    Tracks the size and last use of every entry in cacheDir and
+    planDir and evicts the least recently used ones once they
+    are older than, or together larger than, the configured limits.
+    Entries are the cached repositories, the plans read from the
+    object store of a control repo and the plan snapshots of
+    earlier runs. Last use is the modification time of the entry,
+    which the scm layer refreshes whenever it uses a cache.
+    Archives keep their own limit, archiveCacheMaxSize, and do not
+    count towards cacheMaxSize. The shared git object store is
+    never evicted since cached repositories borrow from it.
+    The build cache and build history are left alone, only
+    directories laid out like a repository cache are evicted.
+    @param cfg: spanner cfg
+    @type cfg: conary cfg object
+    '''
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    @staticmethod
+    def _children(directory):
+        if not os.path.isdir(directory):
+            return []
+        return [ os.path.join(directory, x)
+                    for x in sorted(os.listdir(directory))
+                    if not x.startswith('.') ]
+
+    def _reserved(self):
+        '''@return: names in cacheDir that are not repository caches'''
+        reserved = set(RESERVED)
+        cacheDir = os.path.abspath(self.cfg.cacheDir)
+        for path in (self.cfg.buildCacheDir, self.cfg.buildHistoryFile):
+            path = os.path.join(cacheDir, path)
+            if path.startswith(cacheDir + os.sep):
+                reserved.add(path[len(cacheDir) + 1:].split(os.sep)[0])
+        return reserved
+
+    @staticmethod
+    def _isRepo(path):
+        return any([ os.path.isdir(os.path.join(path, x))
+                        for x in REPO_KINDS ])
+
+    def repos(self):
+        '''@return: entries for the cached repositories'''
+        reserved = self._reserved()
+        return [ CacheEntry('repos', x, locked=True)
+                    for x in self._children(self.cfg.cacheDir)
+                    if os.path.basename(x) not in reserved
+                    and self._isRepo(x) ]
+
+    def plans(self):
+        '''@return: entries for plans read from the object store'''
+        entries = []
+        root = os.path.join(self.cfg.cacheDir, PLANS)
+        for repo in self._children(root):
+            entries.extend([ CacheEntry('plans', x)
+                                for x in self._children(repo) ])
+        return entries
+
+    def snapshots(self):
+        '''@return: entries for the plan snapshots in planDir'''
+        return [ CacheEntry('snapshots', x)
+                    for x in self._children(self.cfg.planDir) ]
+
+    def _archives(self):
+        return archive.getArchiveCache(self.cfg.cacheDir,
+                                       self.cfg.archiveCacheMaxSize * MB)
+
+    def stats(self):
+        '''
+        @return: list of (area, entries, bytes, seconds since the
+                 oldest use) for every area
+        '''
+        results = []
+        for area, entries in (('repos', self.repos()),
+                              ('plans', self.plans()),
+                              ('snapshots', self.snapshots())):
+            oldest = entries and max([ x.age for x in entries ]) or 0
+            results.append((area, len(entries),
+                            sum([ x.size for x in entries ]), oldest))
+        archives = self._archives().entries()
+        oldest = archives and time.time() - min([ x[0] for x in archives ]) or 0
+        results.append(('archives', len(archives),
+                        sum([ x[1] for x in archives ]), oldest))
+        objects = os.path.join(self.cfg.cacheDir, OBJECTS)
+        if os.path.isdir(objects):
+            results.append(('objects', 1, diskUsage(objects), 0))
+        return results
+
+    def expired(self):
+        '''
+        @return: entries to evict, oldest first
+        '''
+        evict = []
+        maxAge = self.cfg.cacheMaxAge * DAY
+        maxSize = self.cfg.cacheMaxSize * MB
+        entries = sorted(self.repos() + self.plans(),
+                         key=lambda x: x.atime)
+        total = sum([ x.size for x in entries ])
+        for entry in entries:
+            if ((maxAge and entry.age > maxAge)
+                    or (maxSize and total > maxSize)):
+                evict.append(entry)
+                total -= entry.size
+        planMaxAge = self.cfg.planMaxAge * DAY
+        if planMaxAge:
+            evict.extend([ x for x in sorted(self.snapshots(),
+                                             key=lambda x: x.atime)
+                            if x.age > planMaxAge ])
+        return evict
+
+    def _remove(self, entry):
+        '''
+        remove an entry, repositories only while nobody else holds
+        their lock
+        @return: True if the entry was removed
+        '''
+        if entry.locked:
+            existed = os.path.exists(os.path.join(entry.path,
+                                                  cachelock.LOCK_FILE))
+            try:
+                with cachelock.CacheLock(entry.path, blocking=False):
+                    # Used since we looked at it
+                    if existed and os.stat(entry.path).st_mtime > entry.atime:
+                        return False
+                    # Lockers waiting on the old lock file notice
+                    # it is gone and start over on a new cache
+                    self._rmtree(entry.path)
+            except (IOError, OSError), err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES,
+                                     errno.ENOENT):
+                    raise
+                logger.info('Skipping %s, it is in use' % entry.path)
+                return False
+            return True
+        self._rmtree(entry.path)
+        return True
+
+    @staticmethod
+    def _rmtree(path):
+        # Move the entry out of the way first so nobody
+        # sees it half removed
+        dirname, name = os.path.split(path)
+        doomed = os.path.join(dirname, '.%s.%s.removing' % (name,
+                                                            os.getpid()))
+        os.rename(path, doomed)
+        if os.path.isdir(doomed):
+            shutil.rmtree(doomed, ignore_errors=True)
+        else:
+            os.unlink(doomed)
+
+    def prune(self, dryRun=False):
+        '''
+        evict expired entries and old archives
+        @keyword dryRun: only report what would be removed
+        @return: list of the C{CacheEntry} objects removed
+        '''
+        removed = []
+        for entry in self.expired():
+            if dryRun:
+                removed.append(entry)
+                continue
+            if self._remove(entry):
+                logger.info('Removed %s (%s bytes, unused for %.1f days)' %
+                            (entry.path, entry.size, entry.age / DAY))
+                removed.append(entry)
+        if not dryRun:
+            self._archives().prune()
+        return removed
@@ -20,12 +20,16 @@ between conary version and SCM repository
 
 import logging
 import os
+import threading
+import urlparse
 
+from . import buildcache
 from . import config
 from . import errors
 from . import package
 from . import controller
 from . import factory
+from . import scheduler
 from rev_file import RevisionFile
 
 logger = logging.getLogger(__name__)
@@ -65,19 +69,21 @@ class PlanUtils(object):
             repositories = plan.getRepositories(macros)
         return repositories
 
-    def get_controllers(self, plan, branch=None):
+    def get_controller_args(self, plan, branch=None):
         '''
         Figure out from the plan what type of controller
         to use for fetching from repo
             - WMS
             - GIT
             - HG    -- Not Implemented
-            - LOCAL -- Not Implemented
+            - LOCAL -- Only as the control repo, not in plans
 
         @param plan: uri to plan
         @type uri: C{string}
+        @return: dict of repository name to the arguments
+                 for C{Controller.create}
         '''
-        controllers = {}
+        args = {}
         base = None
         repositories = self.get_repositories(plan, branch)
         for name, values in repositories.iteritems():
@@ -100,14 +106,19 @@ class PlanUtils(object):
                 if len(path.split('?')) == 2:
                     path, branch = path.split('?')
             if base and path:
-                ctrlr = controller.Controller.create(   
-                                                    ctrltype, 
-                                                    base, 
-                                                    path, 
-                                                    branch,
-                                                    rev,
-                                                    )
-                controllers.setdefault(name, ctrlr)
+                args.setdefault(name, (ctrltype, base, path, branch, rev))
+        return args
+
+    def get_controllers(self, plan, branch=None, cfg=None):
+        '''
+        Create the controllers for the repositories of a plan
+        @param plan: uri to plan
+        @type uri: C{string}
+        @keyword cfg: spanner cfg handed to the controllers
+        '''
+        controllers = {}
+        for name, args in self.get_controller_args(plan, branch).iteritems():
+            controllers[name] = controller.Controller.create(*args, cfg=cfg)
         return controllers
 
 
@@ -168,13 +179,17 @@ class Checker(PlanUtils):
                 raise errors.SpannerBranchError([branch, self.branch])
         # END           
 
+        planDigest = buildcache.BuildCache.planDigest(path, macros)
+        repositories = self.get_repositories(plan, branch)
+        # Controllers are created by _get_controllers for the whole
+        # section at once, until then only their arguments are kept
+        controllers = self.get_controller_args(plan, branch)
+
         for target in plan.getTargets():
             logger.info('Working on %s' % target)
 
             label = plan.getTargetLabel()
             logger.debug('Target Label : %s' % label.asString())
-            repositories = self.get_repositories(plan, branch)
-            controllers = self.get_controllers(plan, branch)   
             # Create initial package
             bobsect = plan.getSection('target:%s'%target)
             scm = bobsect.scm or bobsect.sourceTree.split()[0]
@@ -184,23 +199,25 @@ class Checker(PlanUtils):
                             branch=branch,
                             repositories=repositories,
                             label=label,
-                            controllers=controllers,
+                            controllers=dict(controllers),
                             bobplan=path,
                             scm=scm,
+                            after=getattr(bobsect, 'after', None) or [],
+                            sourceTree=bobsect.sourceTree,
+                            planDigest=planDigest,
                         )
             pkgs.add(pkg)
         return pkgs
 
     @classmethod
-    def _get_commit_hash(cls, pkg):
-        ''' 
-        The commit hash we want to build 
-        needs to be from the revisions.txt if supplied
+    def _commit_controller(cls, pkg):
+        '''
         @param pkg: pkg object with ctrlrs
+        @return: name of the controller the commit to build comes from
         '''
-        commit = None
-        ctrlr = pkg.controllers.get(pkg.scm)
-        if not ctrlr and pkg.controllers:
+        if pkg.scm in pkg.controllers:
+            return pkg.scm
+        if pkg.controllers:
             # TODO
             # add revision.txt info to source pkg metadata 
             # so we can figure out the revisions 
@@ -209,11 +226,122 @@ class Checker(PlanUtils):
             # Currently do not support multiple 
             # scms not named after package
             assert len(pkg.controllers) == 1
-            ctrlr = pkg.controllers.itervalues().next()
+            return pkg.controllers.keys()[0]
+        return None
+
+    @classmethod
+    def _get_commit_hash(cls, pkg):
+        ''' 
+        The commit hash we want to build 
+        needs to be from the revisions.txt if supplied
+        @param pkg: pkg object with ctrlrs
+        '''
+        commit = None
+        ctrlr = pkg.controllers.get(cls._commit_controller(pkg))
         if ctrlr:
             commit = ctrlr.revision
         return { 'commit' : commit }
 
+    @staticmethod
+    def _host(args):
+        '''host a controller created from args talks to'''
+        base = args[1]
+        return urlparse.urlparse(base).netloc or base
+
+    def _create_controller(self, args, resolve, semaphore):
+        '''
+        worker body creating a controller and looking up its revision
+        '''
+        semaphore.acquire()
+        try:
+            ctrlr = controller.Controller.create(*args, cfg=self.cfg)
+            if resolve:
+                try:
+                    ctrlr.resolve()
+                except Exception, err:
+                    logger.warn('Unable to resolve revision of %s : %s' %
+                                (args[2], err))
+            return ctrlr
+        finally:
+            semaphore.release()
+
+    def _get_controllers(self, packages):
+        '''
+        Create the controllers of every package and resolve the
+        revisions that are needed to detect changes.
+        Each repository is contacted once no matter how many
+        plans reference it, lookups run concurrently with at most
+        checkHostThreads of them talking to the same host.
+        '''
+        wanted = {}
+        for name, pkgs in packages.items():
+            for pkg in pkgs:
+                commit = self._commit_controller(pkg)
+                for ctrlname, args in pkg.controllers.items():
+                    resolve = wanted.get(args, False) or ctrlname == commit
+                    wanted[args] = resolve
+
+        byhost = {}
+        for args in sorted(wanted):
+            byhost.setdefault(self._host(args), []).append(args)
+        semaphores = dict([ (x, threading.BoundedSemaphore(
+                                max(1, self.cfg.checkHostThreads)))
+                                for x in byhost ])
+        pool = scheduler.BuildScheduler(jobs=self.cfg.checkThreads)
+        # Interleave hosts so a slow host does not hold every worker
+        queues = byhost.values()
+        while queues:
+            for queue in queues:
+                args = queue.pop(0)
+                pool.add('%s:%s/%s?%s@%s' % args, self._create_controller,
+                         args, wanted[args], semaphores[self._host(args)])
+            queues = [ x for x in queues if x ]
+        logger.info('Resolving %s repositories on %s hosts' %
+                    (len(wanted), len(byhost)))
+
+        created = {}
+        for job in pool.run():
+            if job.error is not None:
+                raise job.error
+            created[job.args[0]] = job.result
+
+        for name, pkgs in packages.items():
+            for pkg in pkgs:
+                pkg.controllers = dict([ (x, created[y])
+                                for x, y in pkg.controllers.items() ])
+        return packages
+
+    @staticmethod
+    def _refresh_cache(ctrlr):
+        '''worker body refreshing the cache of one repository'''
+        try:
+            ctrlr.updatecache()
+        except Exception, err:
+            logger.warn('Unable to refresh the cache of %s : %s' %
+                        (ctrlr.location, err))
+
+    def _refresh_caches(self, packages):
+        '''
+        Refresh the caches of every git and hg repository the plans
+        reference, cacheRefreshThreads at a time. Each cache is locked
+        while it is fetched into and a refresh done by another run
+        less than cacheFreshness seconds ago is reused.
+        '''
+        ctrlrs = {}
+        for name, pkgs in packages.items():
+            for pkg in pkgs:
+                for ctrlr in pkg.controllers.values():
+                    if ctrlr.ControllerType in ('GIT', 'HG'):
+                        ctrlrs.setdefault('%s?%s' % (ctrlr.location,
+                                          ctrlr.branch), ctrlr)
+        pool = scheduler.BuildScheduler(
+                            jobs=max(1, self.cfg.cacheRefreshThreads))
+        for name in sorted(ctrlrs):
+            pool.add(name, self._refresh_cache, ctrlrs[name])
+        logger.info('Refreshing the caches of %s repositories' % len(ctrlrs))
+        pool.run()
+        return packages
+
     def _get_commit_hashes(self, packages):
         '''iter over packages and set  commit hash values'''
         for name, pkgs in packages.items():
@@ -277,10 +405,11 @@ class Checker(PlanUtils):
     def _detect_change(self, pkg):
         '''
         detect if a package has changed
-        @return: dict { 'change' : Boolean }
+        @return: dict { 'change' : Boolean, 'forced' : Boolean }
         '''
         # Start by assuming package did not change
         change = False
+        forced = False
         if pkg.commit:
             # This means we found the branch in info
             # and extracted the commit record
@@ -303,13 +432,14 @@ class Checker(PlanUtils):
             # if --force-build specified at command line
             # we need to build that target
             change = True
+            forced = True
 
         if not change:
             logger.debug('Package %s revision %s '
                     'matches Git repo commit %s' 
                     % (pkg.target, pkg.revision, pkg.commit))
 
-        return {'change': change}
+        return {'change': change, 'forced': forced}
 
     def _detect_changes(self, packages):
         '''loop through packages looking for changes'''
@@ -340,6 +470,9 @@ class Checker(PlanUtils):
                 pkgs = {}
                 for path in paths:
                     pkgs.update(self._check_plans_in_dir(path))
+                pkgs = self._get_controllers(pkgs)
+                if self.cfg.refreshCaches:
+                    pkgs = self._refresh_caches(pkgs)
                 pkgs = self._get_conary_versions(pkgs)
                 pkgs = self._get_commit_hashes(pkgs)
                 pkgs = self._detect_changes(pkgs)
@@ -363,6 +496,15 @@ class Checker(PlanUtils):
         '''
         return self._get_packages(self.plans)
 
+    def recheck(self, packages):
+        '''
+        Detect changes again in packages of an earlier check,
+        the builds since then refreshed their conary versions
+        @param packages: C{dict} of { plan : packages }
+        @return: updated packages
+        '''
+        return self._detect_changes(packages)
+
     def main(self):
         '''Main call for Checker'''
         return self.check()
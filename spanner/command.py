@@ -88,6 +88,10 @@ class BuilderCommand(SpannerCommand):
         argDef['dry-run'] = options.NO_PARAM
         argDef['group'] = options.NO_PARAM
         argDef['products'] = options.NO_PARAM
+        argDef['jobs'] = options.ONE_PARAM
+        argDef['explain-schedule'] = options.NO_PARAM
+        argDef['resume'] = options.NO_PARAM
+        argDef['watch'] = options.NO_PARAM
 
     def shouldRun(self):
         if self.uri:
@@ -102,6 +106,10 @@ class BuilderCommand(SpannerCommand):
         self.test = argSet.pop('dry-run', False)
         self.group = argSet.pop('group', False)
         self.products = argSet.pop('products', False)
+        self.jobs = argSet.pop('jobs', None)
+        self.explain = argSet.pop('explain-schedule', False)
+        self.resume = argSet.pop('resume', False)
+        self.watch = argSet.pop('watch', False)
 
         if not len(params) >= 3:
             return self.usage()
@@ -122,8 +130,14 @@ class BuilderCommand(SpannerCommand):
                                     group=self.group,
                                     products=self.products, 
                                     test=self.test,
+                                    jobs=self.jobs and int(self.jobs),
+                                    explain=self.explain,
+                                    resume=self.resume,
                                     )
-        spanner.main()
+        if self.watch:
+            spanner.watch()
+        else:
+            spanner.main()
 
 
 class GroupBuilderCommand(SpannerCommand):
@@ -179,6 +193,8 @@ class ProductBuilderCommand(SpannerCommand):
         argDef['branch'] = options.ONE_PARAM
         argDef['cfgfile'] = options.ONE_PARAM
         argDef['dry-run'] = options.NO_PARAM
+        argDef['jobs'] = options.ONE_PARAM
+        argDef['explain-schedule'] = options.NO_PARAM
 
     def shouldRun(self):
         if self.uri:
@@ -191,6 +207,8 @@ class ProductBuilderCommand(SpannerCommand):
         self.cfgfile = argSet.pop('cfgfile', None)
         self.branch = argSet.pop('branch', None)
         self.test = argSet.pop('dry-run', False)
+        self.jobs = argSet.pop('jobs', None)
+        self.explain = argSet.pop('explain-schedule', False)
 
         if not len(params) >= 3:
             return self.usage()
@@ -205,6 +223,8 @@ class ProductBuilderCommand(SpannerCommand):
                                     branch=self.branch, 
                                     cfgfile=self.cfgfile,
                                     test=self.test,
+                                    jobs=self.jobs and int(self.jobs),
+                                    explain=self.explain,
                                     )
 
         spanner.buildProducts()
@@ -254,3 +274,42 @@ class PlanCommand(SpannerCommand):
         results = plans.plan()
         print "Plans built : %s" % results
 
+
+class CacheCommand(SpannerCommand):
+    commands = ['cache']
+    paramHelp = '<stats|prune>'
+    help = "Show or prune the cache and plan directories"
+    requireConfig = True
+
+    def addParameters(self, argDef):
+        SpannerCommand.addParameters(self, argDef)
+        argDef['cfgfile'] = options.ONE_PARAM
+        argDef['dry-run'] = options.NO_PARAM
+
+    def runCommand(self, cfg, argSet, params, **kw):
+        cfgfile = argSet.pop('cfgfile', None)
+        test = argSet.pop('dry-run', False)
+
+        if len(params) != 3 or params[2] not in ('stats', 'prune'):
+            return self.usage()
+
+        from spanner import cachemanager
+        from spanner import config
+        if cfgfile:
+            cfg = config.SpannerConfiguration(config=cfgfile,
+                                              readConfigFiles=True)
+        manager = cachemanager.CacheManager(cfg)
+
+        if params[2] == 'stats':
+            print "%-10s %8s %12s %10s" % ('area', 'entries', 'MB', 'oldest')
+            for area, count, size, oldest in manager.stats():
+                print "%-10s %8d %12.1f %9.1fd" % (area, count,
+                            float(size) / cachemanager.MB,
+                            oldest / cachemanager.DAY)
+            return
+
+        removed = manager.prune(dryRun=test)
+        for entry in removed:
+            print "%s %s" % (test and 'Would remove' or 'Removed', entry.path)
+        print "%s entries, %.1f MB" % (len(removed),
+                float(sum([ x.size for x in removed ])) / cachemanager.MB)
@@ -148,7 +148,46 @@ class SpannerConfiguration(MainConfig):
     planDir                     = (cfg.CfgString, '_plan')
     cacheDir                    = (cfg.CfgString, '_cache')
     gitTarget                   = (cfg.CfgString, 'git-repo')
+    readPlansFromObjects        = (cfg.CfgBool, False)
+    gitFetchDepth               = (cfg.CfgInt, 0)
+    gitFetchFilter              = (cfg.CfgString, '')
+    gitSharedObjects            = (cfg.CfgBool, False)
+    gitRefsTTL                  = (cfg.CfgInt, 0)
+    refreshCaches               = (cfg.CfgBool, False)
+    cacheRefreshThreads         = (cfg.CfgInt, 4)
+    cacheFreshness              = (cfg.CfgInt, 60)
+    cacheMaxSize                = (cfg.CfgInt, 0)       # MB
+    archiveCacheMaxSize         = (cfg.CfgInt, 2048)    # MB
+    cacheMaxAge                 = (cfg.CfgInt, 0)       # days
+    planMaxAge                  = (cfg.CfgInt, 7)       # days
+    planSnapshots               = (cfg.CfgInt, 5)
+    pruneCaches                 = (cfg.CfgBool, True)
     fileNameBlackList           = (cfg.CfgList(cfg.CfgString), ['common.conf'])
+    checkThreads                = (cfg.CfgInt, 8)
+    skipUnchanged               = (cfg.CfgBool, True)
+    checkHostThreads            = (cfg.CfgInt, 4)
+    maxParallelBuilds           = (cfg.CfgInt, 1)
+    recipeDependencies          = (cfg.CfgBool, False)
+    buildHistoryFile            = (cfg.CfgString, 'build-history.json')
+    buildCache                  = (cfg.CfgBool, True)
+    buildCacheDir               = (cfg.CfgString, 'builds')
+    buildCachePromote           = (cfg.CfgBool, False)
+    buildLogDir                 = (cfg.CfgString, 'build-logs')
+    buildLogKeep                = (cfg.CfgInt, 5)
+    buildLogCompress            = (cfg.CfgBool, False)
+    buildTimeout                = (cfg.CfgInt, 0)
+    planTimeouts                = (cfg.CfgDict(cfg.CfgInt), {})
+    totalBuildTimeout           = (cfg.CfgInt, 0)
+    buildRetries                = (cfg.CfgInt, 0)
+    buildRetryDelay             = (cfg.CfgInt, 30)
+    transientErrors             = (cfg.CfgList(cfg.CfgString), 
+                                    ['Connection refused',
+                                     'Connection reset by peer',
+                                     'Connection timed out',
+                                     'Temporary failure in name resolution',
+                                     'Service Unavailable',
+                                     'Bad Gateway',
+                                    ])
 
     def __init__(self, config=None, readConfigFiles=False, ignoreErrors=False):
         super(SpannerConfiguration, self).__init__()
@@ -28,7 +28,7 @@ class Controller(object):
         - WMS
         - GIT
         - HG    -- Not Implemented
-        - LOCAL -- Not Implemented
+        - LOCAL
 
     @param base: base uri for repo
     @type base: string
@@ -38,6 +38,8 @@ class Controller(object):
     @type branch: string 
     @keyword rev: commit revision (defaults to None)
     @type rev: string
+    @keyword cfg: spanner cfg, sets the cache dir and fetch options
+    @type cfg: conary cfg object
     '''
 
     _registry = {}
@@ -55,12 +57,25 @@ class BaseController(object):
 
     CONTROLLERS = ('WMS', 'GIT', 'HG', 'LOCAL')
 
-    def __init__(self, base, path, branch=None, rev=None): 
+    def __init__(self, base, path, branch=None, rev=None, cfg=None): 
         self.base = base       
         self.path = path
         self.branch = branch
         self.rev = rev
+        self.cfg = cfg
         self.repos = {} 
+
+    def _cache(self):
+        '''keyword arguments setting the cache dir of a repository'''
+        if not self.cfg:
+            return {}
+        return {'cache': self.cfg.cacheDir}
+
+    def _freshness(self):
+        '''seconds a refresh of a cached repository is reused for'''
+        if not self.cfg:
+            return 0
+        return self.cfg.cacheFreshness
     
     def _getUri(self):
         '''
@@ -70,6 +85,11 @@ class BaseController(object):
 
     uri = property(_getUri)
 
+    @property
+    def location(self):
+        '''uri of the repository as the controller was created for it'''
+        return self._uri
+
     def updatecache(self):
         '''
         Override depending on Controller Type
@@ -96,6 +116,22 @@ class BaseController(object):
         '''
         raise NotImplementedError
 
+    def resolve(self):
+        '''
+        Return the revision the controller works from
+        looking it up in the repo if it is not pinned
+        Override depending on Controller Type
+        '''
+        return self.revision
+
+    def fingerprint(self):
+        '''
+        Return a digest that only changes when the repo or any
+        repo it controls changes, None if that can not be told cheaply
+        Override depending on Controller Type
+        '''
+        return None
+
     def freeze(self, filename=None):
         '''
         Freeze scm revision for consistency
@@ -136,13 +172,20 @@ class WmsController(BaseController):
 
     ControllerType = 'WMS'
 
-    def __init__(self, base, path, branch=None, rev=None):
+    def __init__(self, base, path, branch=None, rev=None, cfg=None):
         self.base = base
         self.path = path
         self.branch = branch
+        self.cfg = cfg
         self.reposet = set()
         self.revfile = 'revision.txt'
-        self.ctrl = wms.WmsRepository(self.base, self.path, self.branch)
+        self._uri = '/'.join([self.base, self.path])
+        kwargs = self._cache()
+        if self.cfg:
+            kwargs['archiveMaxSize'] = (self.cfg.archiveCacheMaxSize
+                                        * 1024 * 1024)
+        self.ctrl = wms.WmsRepository(self.base, self.path, self.branch,
+                                      **kwargs)
         if rev:
             self.ctrl.revision = rev
 
@@ -182,6 +225,10 @@ class WmsController(BaseController):
         # TODO Use revisions.txt file to set revision and return that.
         return self.ctrl.getTip()
 
+    def fingerprint(self):
+        # The poll of the control repo lists the heads of the forest
+        return self.ctrl.pollFingerprint()
+
 Controller.register(WmsController)
 
 class GitController(BaseController):
@@ -189,14 +236,25 @@ class GitController(BaseController):
 
     ControllerType = 'GIT'
 
-    def __init__(self, base, path, branch=None, rev=None):
+    def __init__(self, base, path, branch=None, rev=None, cfg=None):
         self.base = base
         self.path = path
         self.branch = branch
+        self.cfg = cfg
         self.repos = {}
         self._uri = '/'.join([self.base, self.path])
-        self.ctrl = git.GitRepository(self._uri, self.branch)
+        kwargs = self._cache()
+        if cfg:
+            kwargs.update(depth=cfg.gitFetchDepth,
+                          filter=cfg.gitFetchFilter)
+            if cfg.gitSharedObjects:
+                kwargs['pool'] = os.path.join(cfg.cacheDir, 'git-objects')
+        self.ctrl = git.GitRepository(self._uri, self.branch, **kwargs)
         self.gitcmds = git.GitCommands()
+        if cfg:
+            self.refs = git.getRefCache(cfg.cacheDir, cfg.gitRefsTTL)
+        else:
+            self.refs = git.getRefCache('_cache')
         if rev:
             self.ctrl.revision = rev
 
@@ -204,14 +262,18 @@ class GitController(BaseController):
     def revision(self):
         return self.ctrl.revision
 
+    def _heads(self):
+        '''refs of the remote matching the branch'''
+        return self.refs.heads(self._uri, self.branch)
+
     def check(self):
-        heads = self.gitcmds.ls_remote(self._uri, self.branch)
+        heads = self._heads()
         if heads:
             return True
         return False
     
     def compare_heads(self, test):
-        heads = self.gitcmds.ls_remote(self._uri, self.branch)
+        heads = self._heads()
         for head, commit in heads.items():
             if commit == test:
                 return True
@@ -221,11 +283,27 @@ class GitController(BaseController):
         HEAD = 'HEAD'
         if self.branch:
             HEAD = 'refs/heads/' + self.branch
-        heads = self.gitcmds.ls_remote(self._uri, self.branch)
+        heads = self._heads()
         return heads.get(HEAD)
 
+    def resolve(self):
+        if not self.ctrl.revision:
+            self.ctrl.revision = self.latest()
+        return self.ctrl.revision
+
     def updatecache(self):
-        self.ctrl.updateCache()
+        self.ctrl.updateCache(maxAge=self._freshness())
+
+    def materialize(self, root, subtree=None):
+        '''
+        Write the plans at the head of the branch into a directory
+        under root named after the revision
+        @return: the directory and the paths of the files in it
+        '''
+        self.updatecache()
+        revision = self.resolve()
+        directory = os.path.join(root, self.ctrl.path, revision)
+        return directory, self.ctrl.materialize(directory, subtree)
 
 
 Controller.register(GitController)
@@ -236,13 +314,14 @@ class HgController(BaseController):
 
     ControllerType = 'HG'
 
-    def __init__(self, base, path, branch=None, rev=None):
+    def __init__(self, base, path, branch=None, rev=None, cfg=None):
         self.base = base
         self.path = path
         self.branch = branch
+        self.cfg = cfg
         self.repos = {}
         self._uri = '/'.join([self.base, self.path])
-        self.ctrl = hg.HgRepository(self._uri, self.branch)
+        self.ctrl = hg.HgRepository(self._uri, self.branch, **self._cache())
         if rev:
             self.ctrl.revision = rev
 
@@ -251,23 +330,24 @@ class HgController(BaseController):
         return self.ctrl.revision
 
     def updatecache(self):
-        self.ctrl.updateCache()
+        self.ctrl.updateCache(maxAge=self._freshness())
 
 Controller.register(HgController)
 
 class LocalController(BaseController):
     '''LOCAL Controller'''
-    #FIXME Not Implemented     
 
     ControllerType = 'LOCAL'
 
-    def __init__(self, base, path, branch=None, rev=None):
+    def __init__(self, base, path, branch=None, rev=None, cfg=None):
         self.base = base
         self.path = path
         self.branch = branch
+        self.cfg = cfg
         self.repos = {} 
         self._uri = os.path.join(self.base, self.path)
-        self.ctrl = local.LocalRepository(self._uri, self.branch)
+        self.ctrl = local.LocalRepository(self._uri, self.branch,
+                                          **self._cache())
         if rev:
             self.ctrl.revision = rev
 
@@ -278,6 +358,25 @@ class LocalController(BaseController):
     def check(self):
         return os.path.exists(self._uri)
 
+    def latest(self):
+        return self.ctrl.getTip()
+
+    def resolve(self):
+        # Nothing pins a local tree, it is always at its contents
+        self.ctrl.revision = self.latest()
+        return self.ctrl.revision
+
+    # No fingerprint, the tree does not tell whether the repos its
+    # plans build from moved so runs are never skipped as unchanged
+
+    def changes(self):
+        '''files that changed since the last run'''
+        return self.ctrl.changes()
+
+    def watch(self, timeout=None):
+        '''wait for files to change, return the ones that did'''
+        return self.ctrl.watch(timeout)
+
     def read(self):
         pass
 
@@ -47,6 +47,9 @@ class SpannerBranchError(SpannerError):
 class SpannerBranchError(SpannerError):
     msg = "ERROR: Missing scm uri for repo: %s."
 
+class SpannerDependencyError(SpannerError):
+    msg = "ERROR: dependency cycle between bob plans: %s."
+
 class SpannerInternalError(SpannerError):
     pass
 
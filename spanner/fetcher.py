@@ -17,14 +17,19 @@
 Actions for fetching plans from control repos
 '''
 
+import errno
+import hashlib
 import logging
 import os
+import shutil
 import tempfile
 from conary.lib import util as conary_util
 
 import urllib
+from . import cachemanager
 from . import config
 from . import controller
+from . import scm
 from rev_file import RevisionFile
 
 logger = logging.getLogger(__name__)
@@ -50,9 +55,12 @@ class Fetcher(object):
         self.revision = None
         for localdir in [ self.cfg.planDir, self.cfg.cacheDir ]:
             conary_util.mkdirChain(localdir)
-        self.path = tempfile.mkdtemp(dir=self.cfg.planDir)
+        # Created by fetch so a fetcher only asked for its
+        # fingerprint leaves nothing behind
+        self.path = None
+        self.manifest = None
         self.subtree = self.cfg.plansSubDir
-        if self.is_local(uri):
+        if self.is_local(self.normalize_path(uri)):
             self.subtree = None
         self.fetched = False
         self.revision_file = RevisionFile()
@@ -82,7 +90,7 @@ class Fetcher(object):
             - WMS
             - GIT
             - HG    -- Not Implemented 
-            - LOCAL -- Not Implemented
+            - LOCAL
 
         @param uri: uri to control repo
         @type uri: string
@@ -95,7 +103,8 @@ class Fetcher(object):
         rev = None
         if self.is_local(uri):
             ctrltype = 'LOCAL'
-            raise NotImplementedError
+            uri = os.path.abspath(uri.split('file://', 1)[-1])
+            base, path = os.path.split(uri)
         if base in (self.cfg.wmsBase, config.DEFAULT_WMS):
             base = self.cfg.wmsBase
             path = self._unquote(path.replace('api/repos/', ''))
@@ -118,8 +127,24 @@ class Fetcher(object):
                                             path,
                                             branch,
                                             rev,
+                                            cfg=self.cfg,
                                             )
 
+    def fingerprint(self):
+        '''
+        @return: digest of the state of the control repo, the repos
+                 it controls and the pinned revisions, or None if
+                 the controller can not tell
+        '''
+        fingerprint = self.controller.fingerprint()
+        if not fingerprint:
+            return None
+        digest = hashlib.sha1(fingerprint)
+        for uri in sorted(self.revision_file.revs):
+            rev = self.revision_file.revs[uri]
+            digest.update('\0%s\0%s' % (uri, sorted(rev.items())))
+        return digest.hexdigest()
+
     def _fetch(self):
         '''Fetch the plans from the repo'''
         logger.info('Fetching...')
@@ -131,10 +156,101 @@ class Fetcher(object):
                     (self.uri, self.path))
         self.controller.snapshot(self.path, self.subtree)
 
+    def _materialize(self):
+        '''Read the plans straight from the object store of the repo'''
+        root = os.path.join(self.cfg.cacheDir, 'plans')
+        logger.info('Reading plans from the object store of %s' % self.uri)
+        self.path, self.manifest = self.controller.materialize(root,
+                                                            self.subtree)
+        cachemanager.touch(self.path)
+
+    SNAPSHOT_PREFIX = 'rev-'
+
+    def _snapshotPrefix(self):
+        '''@return: start of the names of snapshots of this uri and branch'''
+        key = '\0'.join([self.uri, self.branch or '', self.subtree or ''])
+        return '%s%s-' % (self.SNAPSHOT_PREFIX,
+                          hashlib.sha1(key).hexdigest()[:12])
+
+    def _snapshotKey(self, revision):
+        '''@return: name of the snapshot of revision in planDir'''
+        return self._snapshotPrefix() + hashlib.sha1(revision).hexdigest()[:12]
+
+    def _expireSnapshots(self):
+        '''
+        remove all but the planSnapshots newest snapshots of this uri
+        and branch, never the one this run uses
+        '''
+        prefix = self._snapshotPrefix()
+        snapshots = []
+        for name in os.listdir(self.cfg.planDir):
+            path = os.path.join(self.cfg.planDir, name)
+            if name.startswith(prefix) and path != self.path:
+                try:
+                    snapshots.append((os.stat(path).st_mtime, path))
+                except OSError:
+                    continue
+        snapshots.sort(reverse=True)
+        for mtime, path in snapshots[self.cfg.planSnapshots - 1:]:
+            logger.debug('Removing old plan snapshot %s' % path)
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _fetchSnapshot(self):
+        '''
+        Reuse the snapshot of the revision the control repo is at,
+        or make one, keyed by uri, branch and revision
+        @return: True if self.path holds the plans
+        '''
+        try:
+            revision = self.controller.resolve()
+        except scm.ScmError, err:
+            logger.warn('Unable to resolve the revision of %s : %s' %
+                        (self.uri, err))
+            return False
+        if not revision:
+            return False
+        path = os.path.join(self.cfg.planDir, self._snapshotKey(revision))
+        if os.path.isdir(path):
+            logger.info('Reusing the plans of %s at %s from %s' %
+                        (self.uri, revision, path))
+            cachemanager.touch(path)
+            self.path = path
+            return True
+        logger.info("Checking control source")
+        if not self.controller.check():
+            return False
+        # Snapshot next to the final directory and move it into place
+        # so a snapshot that exists is always complete
+        self.path = tempfile.mkdtemp(dir=self.cfg.planDir,
+                                     prefix='.' + self.SNAPSHOT_PREFIX)
+        try:
+            self._fetch()
+        except:
+            shutil.rmtree(self.path, ignore_errors=True)
+            raise
+        try:
+            os.rename(self.path, path)
+        except OSError, err:
+            shutil.rmtree(self.path, ignore_errors=True)
+            if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # Another run snapshotted the same revision first
+        self.path = path
+        self._expireSnapshots()
+        return True
+
     def fetch(self):
         '''
         Snapshot the control repo then fetch the plans from snapshot
         '''
+        if (not self.fetched and self.cfg.readPlansFromObjects
+                and hasattr(self.controller, 'materialize')):
+            self._materialize()
+            self.fetched = True
+        if not self.fetched and self.cfg.planSnapshots > 0:
+            self.fetched = self._fetchSnapshot()
+        if self.path is None:
+            self.path = tempfile.mkdtemp(dir=self.cfg.planDir)
         if not self.fetched:
             # TODO Add code to controller type 
             logger.info("Checking control source")
@@ -147,6 +263,12 @@ class Fetcher(object):
                 self.fetched = True
         return self.path
 
+    def reset(self):
+        '''forget the fetched plans so the next fetch snapshots again'''
+        self.fetched = False
+        self.path = None
+        self.manifest = None
+
     def main(self):
         '''Main routine for Fetcher'''
         return self.fetch()
@@ -0,0 +1,99 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Build duration history for bob plans
+'''
+
+import json
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+class BuildHistory(object):
+    '''
+    B{BuildHistory}
+    Wall time of the last few builds of each bob plan kept in a json file.
+    Plans are keyed by their section and file name so the history
+    survives the plans being fetched into a new directory every run
+    @param path: path to the history file
+    @type path: C{string}
+    @keyword samples: number of durations kept per plan
+    @type samples: C{int}
+    '''
+
+    def __init__(self, path, samples=5):
+        self.path = path
+        self.samples = samples
+        self.durations = {}
+        self.load()
+
+    @staticmethod
+    def key(bobplan):
+        '''return section/filename of a plan path'''
+        section, name = os.path.split(os.path.normpath(bobplan))
+        return '/'.join([os.path.basename(section), name])
+
+    def load(self):
+        '''read the history file if there is one'''
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as fobj:
+                self.durations = json.load(fobj)
+        except (IOError, ValueError), err:
+            logger.warn('Ignoring unreadable build history %s : %s' %
+                        (self.path, err))
+            self.durations = {}
+
+    def save(self):
+        '''write the history file atomically'''
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.history')
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(self.durations, fobj, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def record(self, bobplan, duration):
+        '''add the duration of a build of bobplan'''
+        durations = self.durations.setdefault(self.key(bobplan), [])
+        durations.append(round(duration, 1))
+        del durations[:-self.samples]
+
+    def estimate(self, bobplan):
+        '''
+        @return: mean duration of the recorded builds of bobplan
+                 or None if it was never built
+        '''
+        durations = self.durations.get(self.key(bobplan))
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
+
+    def average(self):
+        '''
+        @return: mean duration over every plan in the history
+                 or None if the history is empty
+        '''
+        estimates = [ sum(x) / len(x) for x in self.durations.values() if x ]
+        if not estimates:
+            return None
+        return sum(estimates) / len(estimates)
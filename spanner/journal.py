@@ -0,0 +1,161 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Append only journal of the progress of a spanner run
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Journal(object):
+    '''
+    B{Journal}
+    One json record per line, flushed to disk as soon as it is written
+    so a run that dies can be picked up where it stopped.
+    Records have a kind: phase, build or done.
+    @param path: path to the journal file
+    @type path: C{string}
+    @keyword resume: replay an unfinished journal instead of
+                     starting a new one
+    @type resume: C{bool}
+    '''
+
+    PHASE = 'phase'
+    BUILD = 'build'
+    DONE = 'done'
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.records = []
+        self.previous = None
+        self.failures = 0
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        records = self._read()
+        if records and records[-1].get('kind') == self.DONE:
+            # Kept so an unchanged forest can be skipped
+            self.previous = records[-1]
+        if resume:
+            self.records = records
+            if self.previous:
+                logger.info('Previous run finished, nothing to resume')
+                self.records = []
+            elif self.records:
+                logger.info('Resuming from %s with %s records' %
+                            (self.path, len(self.records)))
+            # Failed builds of skipped phases still make the run unclean
+            built = self.built()
+            self.failures = len(set([ x['plan'] for x in self.records
+                                        if x.get('kind') == self.BUILD
+                                        and x['plan'] not in built ]))
+        # Rewrite what was replayed so a torn last line is dropped
+        self._fobj = open(self.path, 'w')
+        for record in self.records:
+            self._fobj.write(json.dumps(record) + '\n')
+        self._fobj.flush()
+
+    @classmethod
+    def forRun(cls, directory, uri, branch=None, resume=False):
+        '''
+        @return: the journal of runs of uri and branch
+        '''
+        runid = hashlib.sha1('%s\0%s' % (uri, branch or '')).hexdigest()
+        path = os.path.join(directory, 'journal-%s.log' % runid[:12])
+        return cls(path, resume=resume)
+
+    def _read(self):
+        '''read the records of an existing journal'''
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path) as fobj:
+            for line in fobj:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # torn write from the run that died
+                    logger.debug('Ignoring partial journal record %r' % line)
+                    break
+        return records
+
+    def write(self, kind, **data):
+        '''append a record and sync it to disk'''
+        data.update({'kind': kind, 'time': time.time()})
+        line = json.dumps(data) + '\n'
+        self._lock.acquire()
+        try:
+            self._fobj.write(line)
+            self._fobj.flush()
+            os.fsync(self._fobj.fileno())
+        finally:
+            self._lock.release()
+
+    def phase(self, name, **data):
+        '''record the end of a phase of the run'''
+        data['name'] = name
+        self.write(self.PHASE, **data)
+
+    def build(self, plan, commit, rc):
+        '''record the outcome of building a plan'''
+        if rc != 0:
+            self.failures += 1
+        self.write(self.BUILD, plan=plan, commit=commit, rc=rc)
+
+    def done(self, **data):
+        '''
+        record that the run finished and whether every build
+        it made succeeded
+        '''
+        data['clean'] = not self.failures
+        self.write(self.DONE, **data)
+
+    def getPhase(self, name):
+        '''
+        @return: data of the last replayed record of phase name or None
+        '''
+        for record in reversed(self.records):
+            if record.get('kind') == self.PHASE and record.get('name') == name:
+                return record
+        return None
+
+    def built(self):
+        '''
+        @return: dict of plan to commit for the plans the
+                 replayed run built successfully
+        '''
+        plans = {}
+        for record in self.records:
+            if record.get('kind') != self.BUILD:
+                continue
+            if record.get('rc') == 0:
+                plans[record['plan']] = record.get('commit')
+            else:
+                plans.pop(record['plan'], None)
+        return plans
+
+    def close(self):
+        '''close the journal file'''
+        self._fobj.close()
@@ -44,6 +44,7 @@ class SpannerMain(mainhandler.MainHandler):
         command.GroupBuilderCommand,
         command.ProductBuilderCommand,
         command.PlanCommand,
+        command.CacheCommand,
         ]
 
     setSysExcepthook = False
@@ -36,7 +36,8 @@ class Package(object):
                  'buildLabel', 'targetLabel', 'sourceLabel',
                  'commit', 'branch', 'tag', 'allversions', 'latest',
                  'version', 'flavor', 'revision', 'uri', 'change',
-                 'log', 'bobplan', 'next', 'scm',
+                 'log', 'bobplan', 'next', 'scm', 'after', 'sourceTree',
+                 'planDigest', 'forced',
                 ]
 
     def __init__(self, **kwargs):
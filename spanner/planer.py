@@ -156,6 +156,7 @@ class Planer(object):
                                             path,
                                             branch,
                                             rev,
+                                            cfg=self.cfg,
                                             )
 
     @staticmethod
@@ -34,11 +34,15 @@ class Reader(object):
     @type path: string
     @param cfg: spanner cfg  
     @type: conary cfg object
+    @keyword files: paths of the files under path, path is walked
+                    when they are not known
+    @type files: C{list}
     '''  
 
-    def __init__(self, path, cfg):
+    def __init__(self, path, cfg, files=None):
         self.path = path
         self.cfg = cfg
+        self.files = files
         # Default data structure built from this list
         self.subdirs = [ self.cfg.projectsDir, 
                          self.cfg.productsDir,
@@ -53,7 +57,7 @@ class Reader(object):
         logger.debug('Gathering plan files from %s' % self.path)
         plans = defaultdict(dict, dict([(x, set()) for x in self.subdirs]))
 
-        for root, dummy, files in os.walk(self.path):
+        for root, dummy, files in self._walk():
             for subdir in plans: 
                 if os.path.basename(root) == subdir:
                     for fn in files:
@@ -64,6 +68,17 @@ class Reader(object):
         return plans
 
 
+    def _walk(self):
+        '''os.walk of path, or the equivalent built from files'''
+        if self.files is None:
+            return os.walk(self.path)
+        dirs = {}
+        for path in self.files:
+            dirname, filename = os.path.split(path)
+            dirs.setdefault(os.path.join(self.path, dirname),
+                            []).append(filename)
+        return [ (x, [], y) for x, y in sorted(dirs.items()) ]
+
     def read(self):
         '''
         B{Read} 
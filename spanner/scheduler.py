@@ -0,0 +1,366 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+'''
+Bounded worker pool for running bob plans concurrently
+in dependency order
+'''
+
+import datetime
+import heapq
+import logging
+import Queue
+import threading
+import time
+
+from . import errors
+
+
+logger = logging.getLogger(__name__)
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# blocked value of jobs skipped because the deadline passed
+DEADLINE = 'deadline'
+
+
+class BuildJob(object):
+    '''
+    B{BuildJob}
+    A unit of work run by the C{BuildScheduler}
+    @param name: unique name of the job, usually the bob plan
+    @type name: C{string}
+    @param func: callable to run in a worker thread
+    '''
+
+    __slots__ = ['name', 'func', 'args', 'kwargs',
+                 'result', 'error', 'start', 'end',
+                 'status', 'after', 'blocked',
+                ]
+
+    def __init__(self, name, func, *args, **kwargs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.start = None
+        self.end = None
+        self.status = PENDING
+        self.after = set()
+        self.blocked = None
+
+    def __repr__(self):
+        return self.name
+
+    def run(self):
+        '''call func and record the result or the error'''
+        self.start = time.time()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception, err:
+            logger.exception('Job %s raised an exception' % self.name)
+            self.error = err
+        self.end = time.time()
+
+    @property
+    def duration(self):
+        '''wall time of the job in seconds'''
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class BuildScheduler(object):
+    '''
+    B{BuildScheduler}
+    Run jobs with at most C{jobs} of them in flight at once.
+    A job is only started once every job it runs after has succeeded,
+    when a job fails everything that depends on it is skipped.
+    Among the jobs that are ready the ones heading the longest
+    remaining chain of work are started first.
+    Results are handed back to the calling thread as jobs finish
+    so callers never have to share non thread safe objects
+    (like the conary client) with the workers.
+    @keyword jobs: maximum number of concurrent jobs
+    @type jobs: C{int}
+    @keyword failed: callable returning True if a finished job failed,
+                     defaults to jobs that raised
+    @keyword weight: callable returning the expected duration of a job,
+                     defaults to every job taking the same time
+    @keyword deadline: time after which no more jobs are started
+    @type deadline: C{float}
+    '''
+
+    def __init__(self, jobs=1, failed=None, weight=None, deadline=None):
+        self.jobs = max(1, int(jobs or 1))
+        self.failed = failed or (lambda job: False)
+        self.weight = weight or (lambda job: 1)
+        self.deadline = deadline
+        self._ranks = None
+        self._jobs = {}
+        self._order = []
+        self._done = Queue.Queue()
+
+    def add(self, name, func, *args, **kwargs):
+        '''
+        queue a job
+        @return: the queued C{BuildJob}
+        '''
+        job = BuildJob(name, func, *args, **kwargs)
+        self._ranks = None
+        self._jobs[name] = job
+        self._order.append(job)
+        return job
+
+    def depend(self, name, after):
+        '''
+        only run job C{name} after the jobs in C{after} succeed
+        @param name: name of a queued job
+        @param after: names of jobs that have to finish first,
+                      names that are not queued are ignored
+        '''
+        job = self._jobs[name]
+        self._ranks = None
+        for parent in after:
+            if parent == name:
+                continue
+            if parent not in self._jobs:
+                logger.debug('%s runs after %s which is not queued, '
+                             'ignoring' % (name, parent))
+                continue
+            job.after.add(parent)
+
+    def children(self):
+        '''
+        @return: dict of job name to the names of the jobs
+                 waiting on it
+        '''
+        children = dict([ (x.name, set()) for x in self._order ])
+        for job in self._order:
+            for parent in job.after:
+                children[parent].add(job.name)
+        return children
+
+    def toposort(self):
+        '''
+        @return: jobs in an order that satisfies every dependency
+        @raise SpannerDependencyError: if the dependencies have a cycle
+        '''
+        children = self.children()
+        waiting = dict([ (x.name, len(x.after)) for x in self._order ])
+        ready = [ x.name for x in self._order if not waiting[x.name] ]
+        ordered = []
+        while ready:
+            name = ready.pop(0)
+            ordered.append(self._jobs[name])
+            for child in sorted(children[name]):
+                waiting[child] -= 1
+                if not waiting[child]:
+                    ready.append(child)
+        if len(ordered) != len(self._order):
+            cycle = sorted([ x for x, y in waiting.items() if y ])
+            raise errors.SpannerDependencyError(cycle)
+        return ordered
+
+    def ranks(self):
+        '''
+        @return: dict of job name to the expected duration of the
+                 longest chain of jobs starting with it
+        '''
+        if self._ranks is None:
+            children = self.children()
+            ranks = {}
+            for job in reversed(self.toposort()):
+                tail = [ ranks[x] for x in children[job.name] ]
+                ranks[job.name] = self.weight(job) + max(tail or [0])
+            self._ranks = ranks
+        return self._ranks
+
+    def criticalPath(self):
+        '''
+        @return: names of the jobs on the longest chain and
+                 its expected duration
+        '''
+        ranks = self.ranks()
+        children = self.children()
+        path = []
+        heads = [ x.name for x in self._order if not x.after ]
+        while heads:
+            name = max(heads, key=lambda x: ranks[x])
+            path.append(name)
+            heads = list(children[name])
+        if not path:
+            return path, 0
+        return path, ranks[path[0]]
+
+    def simulate(self):
+        '''
+        Predict the schedule assuming every job succeeds
+        and takes as long as its weight
+        @return: dict of job name to expected start time
+                 and the expected makespan
+        '''
+        ranks = self.ranks()
+        pending = list(self._order)
+        done = set()
+        running = []
+        starts = {}
+        now = 0
+        while pending or running:
+            ready = [ x for x in pending if x.after <= done ]
+            ready.sort(key=lambda x: -ranks[x.name])
+            while ready and len(running) < self.jobs:
+                job = ready.pop(0)
+                pending.remove(job)
+                starts[job.name] = now
+                heapq.heappush(running, (now + self.weight(job), job.name))
+            now, name = heapq.heappop(running)
+            done.add(name)
+        return starts, now
+
+    def explain(self):
+        '''
+        @return: lines of text describing the predicted schedule,
+                 critical path and makespan
+        '''
+        fmt = lambda x: str(datetime.timedelta(seconds=int(round(x))))
+        starts, makespan = self.simulate()
+        path, length = self.criticalPath()
+        lines = ['Predicted schedule (%s at a time):' % self.jobs,
+                 '\t%-10s%-10s%s' % ('start', 'estimate', 'plan')]
+        for job in sorted(self._order, key=lambda x: starts[x.name]):
+            lines.append('\t%-10s%-10s%s' % (fmt(starts[job.name]),
+                                    fmt(self.weight(job)), job.name))
+        lines.append('Critical path (%s):' % fmt(length))
+        lines.extend([ '\t%s' % x for x in path ])
+        lines.append('Predicted makespan: %s' % fmt(makespan))
+        return lines
+
+    def _target(self, job):
+        '''worker thread body'''
+        try:
+            job.run()
+        finally:
+            self._done.put(job)
+
+    def _start(self, job):
+        '''start a job in its own worker thread'''
+        logger.debug('Starting job %s' % job.name)
+        job.status = RUNNING
+        thread = threading.Thread(target=self._target, args=(job,),
+                                  name='build-%s' % job.name)
+        thread.daemon = True
+        thread.start()
+
+    def _wait(self):
+        '''
+        wait a second for a job to finish
+        polls so the main thread still sees KeyboardInterrupt
+        and notices the deadline passing
+        @return: the finished job or None
+        '''
+        try:
+            return self._done.get(True, 1)
+        except Queue.Empty:
+            return None
+
+    def _expire(self):
+        '''skip every pending job once the deadline has passed'''
+        if not self.deadline or time.time() < self.deadline:
+            return []
+        expired = [ x for x in self._order if x.status == PENDING ]
+        for job in expired:
+            job.status = SKIPPED
+            job.blocked = DEADLINE
+        if expired:
+            logger.error('Build deadline passed, skipping %s' % expired)
+        return expired
+
+    def _ready(self):
+        '''
+        pending jobs whose dependencies all succeeded,
+        longest remaining chain first
+        '''
+        ranks = self.ranks()
+        ready = [ x for x in self._order if x.status == PENDING
+                    and not [ y for y in x.after
+                                if self._jobs[y].status != DONE ] ]
+        ready.sort(key=lambda x: -ranks[x.name])
+        return ready
+
+    def _prune(self, job, children):
+        '''skip every job downstream of a failed job'''
+        pruned = []
+        stack = list(children[job.name])
+        while stack:
+            child = self._jobs[stack.pop()]
+            if child.status != PENDING:
+                continue
+            child.status = SKIPPED
+            child.blocked = job.name
+            logger.warn('Skipping %s because %s failed' % (child.name,
+                                                           job.name))
+            pruned.append(child)
+            stack.extend(children[child.name])
+        return pruned
+
+    def run(self, callback=None):
+        '''
+        Run all queued jobs
+        @keyword callback: called in the calling thread with each
+                           C{BuildJob} as it finishes or is skipped
+        @return: list of finished jobs in completion order
+        '''
+        self.ranks()
+        children = self.children()
+        finished = []
+        running = 0
+        while True:
+            for job in self._expire():
+                finished.append(job)
+                if callback:
+                    callback(job)
+            for job in self._ready():
+                if running >= self.jobs:
+                    break
+                self._start(job)
+                running += 1
+            if not running:
+                break
+            job = self._wait()
+            if job is None:
+                continue
+            running -= 1
+            if job.error is not None or self.failed(job):
+                job.status = FAILED
+            else:
+                job.status = DONE
+            logger.debug('Finished job %s (%s) in %.1fs' % (job.name,
+                                            job.status, job.duration or 0))
+            pruned = []
+            if job.status == FAILED:
+                pruned = self._prune(job, children)
+            for done in [job] + pruned:
+                finished.append(done)
+                if callback:
+                    callback(done)
+        return finished
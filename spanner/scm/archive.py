@@ -0,0 +1,247 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+'''
+Content addressed cache of source archives
+'''
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = 'archives'
+# Default size limit of the cache in bytes
+MAX_SIZE = 2 * 1024 * 1024 * 1024
+CHUNK = 65536
+
+
+class ArchiveCache(object):
+    '''
+    B{ArchiveCache}
+    Archives of exact revisions never change, so they are kept on
+    disk keyed by repo path, revision, subtree and archive name.
+    Hits refresh the modification time of an entry, the least
+    recently used entries are removed once the cache grows past
+    maxSize.
+    @param directory: where archives are kept
+    @type directory: C{string}
+    @keyword maxSize: size limit in bytes, 0 for no limit
+    @type maxSize: C{int}
+    '''
+
+    def __init__(self, directory, maxSize=MAX_SIZE):
+        self.directory = directory
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path, revision, subtree, name):
+        '''
+        @return: cache key of an archive or None if revision
+                 is not an exact commit
+        '''
+        if not revision or len(revision) != 40:
+            return None
+        return hashlib.sha1('\0'.join([path, revision, subtree or '',
+                                       name])).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        '''
+        @return: path to the cached archive or None on a miss
+        '''
+        if not key:
+            return None
+        path = self._path(key)
+        try:
+            os.utime(path, None)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        logger.debug('Archive cache hit %s' % key)
+        return path
+
+    def open(self, key):
+        '''
+        @return: C{ArchiveWriter} filling the entry for key
+        '''
+        dirname = os.path.dirname(self._path(key))
+        try:
+            os.makedirs(dirname)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+        return ArchiveWriter(self, key, dirname)
+
+    def put(self, key, fobj):
+        '''
+        copy fobj into the cache
+        @return: path to the cached archive
+        '''
+        writer = self.open(key)
+        try:
+            while True:
+                data = fobj.read(CHUNK)
+                if not data:
+                    break
+                writer.write(data)
+        except:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def copy(self, key, dest):
+        '''
+        link or copy the archive of key to dest
+        '''
+        path = self._path(key)
+        try:
+            os.link(path, dest)
+        except OSError:
+            shutil.copyfile(path, dest)
+
+    def entries(self):
+        '''
+        @return: list of (mtime, size, path) of the cached archives
+        '''
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def prune(self):
+        '''
+        remove least recently used archives until the cache fits
+        @return: number of bytes removed
+        '''
+        if not self.maxSize:
+            return 0
+        self._lock.acquire()
+        try:
+            entries = sorted(self.entries())
+            total = sum([ x[1] for x in entries ])
+            removed = 0
+            while entries and total > self.maxSize:
+                _, size, path = entries.pop(0)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += size
+            if removed:
+                logger.info('Removed %s bytes of old archives from %s' %
+                            (removed, self.directory))
+            return removed
+        finally:
+            self._lock.release()
+
+
+class ArchiveWriter(object):
+    '''
+    Temporary file that becomes a cache entry once it is complete
+    '''
+
+    def __init__(self, cache, key, dirname):
+        self.cache = cache
+        self.key = key
+        fd, self.tmp = tempfile.mkstemp(dir=dirname, prefix='.' + key)
+        self.fobj = os.fdopen(fd, 'wb')
+        self.time = time.time()
+
+    def write(self, data):
+        self.fobj.write(data)
+
+    def commit(self):
+        '''
+        move the finished archive into place
+        @return: path to the cached archive
+        '''
+        self.fobj.close()
+        path = self.cache._path(self.key)
+        os.rename(self.tmp, path)
+        logger.debug('Cached archive %s in %.1fs' % (self.key,
+                                            time.time() - self.time))
+        self.cache.prune()
+        return path
+
+    def abort(self):
+        '''throw away a partial archive'''
+        self.fobj.close()
+        if os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+
+
+class TeeReader(object):
+    '''
+    File like reader copying everything read from fobj into writer
+    '''
+
+    def __init__(self, fobj, writer):
+        self.fobj = fobj
+        self.writer = writer
+
+    def read(self, size=-1):
+        data = self.fobj.read(size)
+        if data:
+            self.writer.write(data)
+        return data
+
+    def close(self):
+        self.fobj.close()
+
+
+_caches = {}
+_cachesLock = threading.Lock()
+
+
+def getArchiveCache(cache, maxSize=None):
+    '''
+    @keyword maxSize: size limit in bytes, the default or the
+                      limit given earlier when None
+    @return: the C{ArchiveCache} kept in the cache directory
+    '''
+    directory = os.path.join(cache, ARCHIVE_DIR)
+    _cachesLock.acquire()
+    try:
+        if directory not in _caches:
+            _caches[directory] = ArchiveCache(directory)
+        if maxSize is not None:
+            _caches[directory].maxSize = maxSize
+        return _caches[directory]
+    finally:
+        _cachesLock.release()
@@ -0,0 +1,122 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+'''
+File locks and freshness stamps for cached repositories
+'''
+
+import errno
+import fcntl
+import os
+import time
+
+LOCK_FILE = 'spanner.lock'
+STAMP_FILE = 'spanner.stamp'
+
+
+class CacheLock(object):
+    '''
+    B{CacheLock}
+    Exclusive flock on a cache directory, held while a cached
+    repository is created or fetched into so neither threads nor
+    other spanner processes sharing the cache write to it at once.
+    A stamp file in the directory records the last refresh.
+    Use it as a context manager.
+    @param directory: cache directory to lock
+    @type directory: C{string}
+    @keyword blocking: raise IOError instead of waiting
+                       when somebody else holds the lock
+    @type blocking: C{bool}
+    '''
+
+    def __init__(self, directory, blocking=True):
+        self.directory = directory
+        self.blocking = blocking
+        self.fobj = None
+
+    def _current(self, fobj):
+        '''True if fobj is still the lock file of the directory'''
+        try:
+            st = os.stat(os.path.join(self.directory, LOCK_FILE))
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+        fst = os.fstat(fobj.fileno())
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+    def __enter__(self):
+        flags = fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        while True:
+            # Only waiting lockers create the cache, the cache manager
+            # uses a non blocking lock on entries it is removing
+            try:
+                if self.blocking:
+                    os.makedirs(self.directory)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+            fobj = open(os.path.join(self.directory, LOCK_FILE), 'a')
+            try:
+                fcntl.flock(fobj.fileno(), flags)
+            except IOError:
+                fobj.close()
+                raise
+            # The cache manager may have removed the directory while
+            # we waited, the lock we got then guards nothing
+            if self._current(fobj):
+                break
+            fobj.close()
+        self.fobj = fobj
+        return self
+
+    def __exit__(self, *exc):
+        # Closing the file drops the lock
+        self.fobj.close()
+        self.fobj = None
+        return False
+
+    def age(self):
+        '''@return: seconds since the last refresh or None'''
+        try:
+            mtime = os.stat(os.path.join(self.directory, STAMP_FILE)).st_mtime
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        return time.time() - mtime
+
+    def fresh(self, maxAge):
+        '''@return: True if the cache was refreshed less than maxAge ago'''
+        if not maxAge:
+            return False
+        age = self.age()
+        return age is not None and age < maxAge
+
+    def used(self):
+        '''record a use of the cache, which the cache manager evicts by'''
+        os.utime(self.directory, None)
+
+    def touch(self):
+        '''record a refresh'''
+        path = os.path.join(self.directory, STAMP_FILE)
+        with open(path, 'a'):
+            pass
+        os.utime(path, None)
@@ -0,0 +1,139 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+'''
+Streaming decompression of downloaded archives
+'''
+
+import logging
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+class Identity(object):
+    '''passes data through untouched'''
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+
+class Gzip(object):
+
+    def __init__(self):
+        self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        return self.obj.decompress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class Xz(object):
+
+    def __init__(self):
+        self.obj = lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        return self.obj.decompress(data)
+
+    def flush(self):
+        return ''
+
+
+class Zstd(object):
+
+    def __init__(self):
+        self.obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self.obj.decompress(data)
+
+    def flush(self):
+        return ''
+
+
+class Reader(object):
+    '''
+    File like reader returning the decompressed contents of fobj
+    '''
+
+    def __init__(self, fobj, decompressor, chunk=65536):
+        self.fobj = fobj
+        self.decompressor = decompressor
+        self.chunk = chunk
+        self.buf = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            data = self.fobj.read(self.chunk)
+            if data:
+                self.buf += self.decompressor.decompress(data)
+            else:
+                self.buf += self.decompressor.flush()
+                self.eof = True
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def close(self):
+        self.fobj.close()
+
+
+def suffixes():
+    '''
+    @return: archive suffixes we can decompress, best first,
+             ending with the uncompressed archive
+    '''
+    result = []
+    if zstandard:
+        result.append('.zst')
+    if lzma:
+        result.append('.xz')
+    result.append('.gz')
+    result.append('')
+    return result
+
+
+def decompressor(suffix):
+    '''
+    @return: decompressor for an archive suffix
+    '''
+    return {'.zst': Zstd,
+            '.xz': Xz,
+            '.gz': Gzip,
+            '': Identity,
+           }[suffix]()
@@ -0,0 +1,268 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+'''
+Process wide pool of persistent HTTP connections
+'''
+
+import httplib
+import logging
+import socket
+import threading
+import urllib
+import urlparse
+
+from .. import scm
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = 300
+MAX_REDIRECTS = 5
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class PooledResponse(object):
+    '''
+    File like wrapper around a response that hands its connection
+    back to the pool once the body has been read to the end
+    '''
+
+    CHUNK = 8192
+
+    def __init__(self, pool, key, conn, response, url):
+        self._buffer = ''
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def _release(self):
+        if self.conn is None:
+            return
+        if self.response.will_close:
+            self.conn.close()
+        else:
+            self.pool._put(self.key, self.conn)
+        self.conn = None
+
+    def _read(self, amt=None):
+        data = self.response.read(amt)
+        if not data or self.response.isclosed():
+            self._release()
+        return data
+
+    def read(self, amt=None):
+        # Whatever readline read past the end of its line comes first
+        data, self._buffer = self._buffer, ''
+        if amt is None:
+            return data + self._read()
+        if len(data) > amt:
+            data, self._buffer = data[:amt], data[amt:]
+            return data
+        return data + self._read(amt - len(data))
+
+    def readline(self):
+        while '\n' not in self._buffer:
+            data = self._read(self.CHUNK)
+            if not data:
+                break
+            self._buffer += data
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed():
+            self._release()
+        else:
+            # Unread body, the connection can not be reused
+            self.conn.close()
+            self.conn = None
+
+
+class ConnectionPool(object):
+    '''
+    B{ConnectionPool}
+    Thread safe pool of keep-alive connections keyed by
+    scheme, host and port, with the same open() interface
+    as the conary URLOpener it replaces.
+    Proxies are taken from the environment, the proxy settings
+    of the conary configuration are not used.
+    Connection failures and error responses raise C{ScmError}
+    instead of the conary C{ResponseError}.
+    @keyword maxIdle: idle connections kept per host
+    @type maxIdle: C{int}
+    @keyword timeout: socket timeout in seconds
+    @type timeout: C{int}
+    '''
+
+    def __init__(self, maxIdle=8, timeout=TIMEOUT):
+        self.maxIdle = maxIdle
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _key(self, scheme, netloc):
+        '''
+        @return: key of the pool to connect through and the
+                 host the request is for
+        '''
+        host = netloc.rsplit('@', 1)[-1]
+        proxy = None
+        proxies = urllib.getproxies()
+        if scheme in proxies and not urllib.proxy_bypass(host.split(':')[0]):
+            proxy = urlparse.urlparse(proxies[scheme]).netloc
+        return (scheme, host, proxy), host
+
+    def _get(self, key):
+        '''@return: an idle connection for key or None'''
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+            return None
+        finally:
+            self._lock.release()
+
+    def _put(self, key, conn):
+        '''park a connection for reuse'''
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxIdle:
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def _connect(self, key):
+        '''open a new connection for key'''
+        scheme, host, proxy = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(proxy or host, timeout=self.timeout)
+            if proxy:
+                conn.set_tunnel(host)
+        else:
+            conn = httplib.HTTPConnection(proxy or host, timeout=self.timeout)
+        return conn
+
+    def _request(self, method, url, body, headers):
+        '''
+        send one request, retrying once on a fresh connection
+        if a reused one turns out to have been closed by the server
+        '''
+        parts = urlparse.urlsplit(url)
+        key, host = self._key(parts.scheme, parts.netloc)
+        path = urlparse.urlunsplit(('', '', parts.path or '/',
+                                    parts.query, ''))
+        if key[2] and parts.scheme == 'http':
+            path = url
+        headers = dict(headers or {})
+        headers.setdefault('Host', host)
+        conn = self._get(key)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = self._connect(key)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), err:
+                conn.close()
+                conn = None
+                if reused:
+                    reused = False
+                    logger.debug('Stale connection to %s, reconnecting : %s'
+                                 % (host, err))
+                    continue
+                raise scm.ScmError(None, str(err), url)
+            return PooledResponse(self, key, conn, response, url)
+
+    def request(self, method, url, body=None, headers=None):
+        '''
+        @return: C{PooledResponse} for url after following redirects
+        @raise ScmError: on connection errors and error responses
+        '''
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(method, url, body, headers)
+            if response.status not in REDIRECTS:
+                break
+            location = response.getheader('location')
+            response.read()
+            response.close()
+            if not location:
+                break
+            url = urlparse.urljoin(url, location)
+            if response.status == 303:
+                method, body = 'GET', None
+        else:
+            raise scm.ScmError(response.status, 'too many redirects', url)
+        if response.status >= 400:
+            response.read()
+            response.close()
+            raise scm.ScmError(response.status, response.reason, url)
+        return response
+
+    def open(self, url, data=None, headers=None):
+        '''
+        GET url, or POST it when form data is given
+        @return: file like C{PooledResponse}
+        '''
+        if data is None:
+            return self.request('GET', url, headers=headers)
+        headers = dict(headers or {})
+        headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        return self.request('POST', url, data, headers)
+
+    def close(self):
+        '''close every idle connection'''
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+_pool = None
+_poolLock = threading.Lock()
+
+
+def getPool():
+    '''
+    @return: the C{ConnectionPool} shared by the whole process
+    '''
+    global _pool
+    _poolLock.acquire()
+    try:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+    finally:
+        _poolLock.release()
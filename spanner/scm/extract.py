@@ -0,0 +1,144 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+'''
+In process extraction of tar streams into snapshot directories
+'''
+
+import logging
+import os
+import posixpath
+import tarfile
+import time
+
+logger = logging.getLogger(__name__)
+
+BUFSIZE = 1024 * 1024
+
+
+class Extractor(object):
+    '''
+    B{Extractor}
+    Extract a tar stream into a directory without a tar process,
+    keeping only the members under subtree.
+    Members may sit below a single leading prefix directory,
+    as they do in WMS archives.
+    @param directory: where to extract to
+    @type directory: C{string}
+    @keyword subtree: only extract this part of the archive
+    @type subtree: C{string}
+    @keyword prefix: leading directory of every member
+    @type prefix: C{string}
+    '''
+
+    def __init__(self, directory, subtree=None, prefix=None):
+        self.directory = directory
+        self.subtree = self._normalize(subtree)
+        self.prefix = self._normalize(prefix)
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+
+    @staticmethod
+    def _normalize(path):
+        if not path:
+            return None
+        path = posixpath.normpath(path).strip('/')
+        if path in ('', '.'):
+            return None
+        return path
+
+    @staticmethod
+    def _under(name, top):
+        return name == top or name.startswith(top + '/')
+
+    def wanted(self, member):
+        '''
+        True if member is inside the subtree
+        @raise RuntimeError: for members named to land
+                             outside the directory
+        '''
+        name = posixpath.normpath(member.name)
+        if (name.startswith('/') or name == '..'
+                or name.startswith('../')):
+            raise RuntimeError('Illegal path %s in archive' % member.name)
+        if not self.subtree:
+            return True
+        if self.prefix and self._under(name, self.prefix):
+            name = name[len(self.prefix) + 1:]
+            if not name:
+                return True
+        if self._under(name, self.subtree):
+            return True
+        # Parent directories of the subtree
+        return member.isdir() and self._under(self.subtree, name)
+
+    def _inside(self, path):
+        '''True if path resolves to somewhere inside the directory'''
+        root = os.path.realpath(self.directory)
+        path = os.path.realpath(path)
+        return path == root or path.startswith(root + os.sep)
+
+    def check(self, member):
+        '''
+        refuse members that would write outside the directory through
+        a symlink extracted earlier, and links pointing outside of it
+        @raise RuntimeError: for such members
+        '''
+        dest = os.path.join(self.directory, member.name)
+        if not self._inside(dest):
+            raise RuntimeError('Illegal path %s in archive, it leaves %s' %
+                               (member.name, self.directory))
+        if member.issym():
+            target = os.path.join(os.path.dirname(dest), member.linkname)
+        elif member.islnk():
+            target = os.path.join(self.directory, member.linkname)
+        else:
+            return
+        if os.path.isabs(member.linkname) or not self._inside(target):
+            raise RuntimeError('Illegal link %s -> %s in archive' %
+                               (member.name, member.linkname))
+
+    def extract(self, fobj):
+        '''
+        extract the tar stream fobj, reading it to the end
+        @return: self, with files and bytes counting what was written
+        '''
+        start = time.time()
+        tar = tarfile.open(fileobj=fobj, mode='r|', bufsize=BUFSIZE)
+        try:
+            for member in tar:
+                if member.name == 'pax_global_header':
+                    continue
+                if not self.wanted(member):
+                    self.skipped += 1
+                    continue
+                self.check(member)
+                tar.extract(member, self.directory)
+                if member.isfile():
+                    self.files += 1
+                    self.bytes += member.size
+        finally:
+            tar.close()
+        # Drain the end of archive padding so readers teeing
+        # the stream see all of it
+        while fobj.read(BUFSIZE):
+            pass
+        logger.debug('Extracted %s files (%s bytes) into %s in %.1fs, '
+                     'skipped %s' % (self.files, self.bytes, self.directory,
+                                     time.time() - start, self.skipped))
+        return self
@@ -10,13 +10,23 @@
 Helper functions for dealing with git repositories.
 '''
 
+import hashlib
+import json
 import logging
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 from .. import scm
+from . import cachelock
+from . import extract
 
 log = logging.getLogger(__name__)
 
+REFS_FILE = 'git-refs.json'
+
 class GitCommands(object):
 
     def __init__(self, cachedir=None):
@@ -145,14 +155,289 @@ class GitCommands(object):
         return self.run_git(cmd, path)
 
 
-class GitRepository(scm.ScmRepository):
+class CatFile(object):
+    '''
+    One long lived git cat-file --batch process reading objects
+    straight out of a repository
+    @param repo_dir: path to the repository
+    @type repo_dir: C{string}
+    '''
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.proc = None
+        self._lock = threading.Lock()
 
-    def __init__(self, uri, branch, cache='_cache'):
+    def _start(self):
+        log.debug("(cd '%s'; git cat-file --batch)", self.repo_dir)
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                cwd=self.repo_dir)
+
+    def read(self, name):
+        '''
+        @param name: any object name git understands, like rev:path
+        @return: sha, type and contents of the object
+        @raise KeyError: if there is no such object
+        '''
+        self._lock.acquire()
+        try:
+            if self.proc is None:
+                self._start()
+            self.proc.stdin.write(name + '\n')
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline()
+            if not header:
+                self.close()
+                raise scm.ScmError(None, 'git cat-file exited', name)
+            fields = header.split()
+            if fields[-1] == 'missing':
+                raise KeyError(name)
+            sha, kind, size = fields
+            data = self.proc.stdout.read(int(size))
+            self.proc.stdout.read(1)
+            return sha, kind, data
+        finally:
+            self._lock.release()
+
+    def tree(self, name):
+        '''
+        @return: list of (mode, name, sha) entries of a tree
+        '''
+        sha, kind, data = self.read(name)
+        if kind != 'tree':
+            raise scm.ScmError(None, '%s is a %s not a tree' % (name, kind))
+        entries = []
+        pos = 0
+        while pos < len(data):
+            space = data.index(' ', pos)
+            nul = data.index('\0', space)
+            entries.append((data[pos:space], data[space + 1:nul],
+                            data[nul + 1:nul + 21].encode('hex')))
+            pos = nul + 21
+        return entries
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc = None
+
+
+class ObjectPool(object):
+    '''
+    B{ObjectPool}
+    Bare repository holding the objects of every cached repository.
+    Caches borrow from it through git alternates so forks, mirrors
+    and gerrit and upstream uris of a project are stored and
+    transferred once. Each uri and branch gets its own ref in the
+    pool so nothing a cache needs is ever garbage collected.
+    Fetches into the pool are serialized with a C{CacheLock},
+    which also covers other spanner processes on the host.
+    @param directory: path to the pool
+    @type directory: C{string}
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects = os.path.abspath(os.path.join(directory, 'objects'))
+
+    def _git(self, *args):
+        return GitCommands().run_git(['git'] + list(args), self.directory)
+
+    @staticmethod
+    def _key(uri):
+        return hashlib.sha1(uri).hexdigest()[:16]
+
+    def _init(self):
+        '''create the pool, the caller holds the lock'''
+        if not os.path.isdir(os.path.join(self.directory, 'refs')):
+            self._git('init', '-q', '--bare')
+
+    def fetch(self, uri, branch):
+        '''
+        fetch branch of uri into the pool
+        @return: commit at the head of the branch
+        '''
+        ref = 'refs/pool/%s/heads/%s' % (self._key(uri), branch)
+        with cachelock.CacheLock(self.directory):
+            self._init()
+            self._git('fetch', '-q', uri, '+%s:%s' % (branch, ref))
+            return self._git('rev-parse', ref).strip()
+
+    def fetchRevision(self, uri, revision):
+        '''fetch a single commit of uri into the pool'''
+        ref = 'refs/pool/%s/pinned/%s' % (self._key(uri), revision)
+        with cachelock.CacheLock(self.directory):
+            self._init()
+            self._git('fetch', '-q', uri, '+%s:%s' % (revision, ref))
+
+    def borrow(self, repo_dir):
+        '''make repo_dir use the objects of the pool'''
+        info = os.path.join(repo_dir, 'objects', 'info')
+        if not os.path.isdir(info):
+            os.makedirs(info)
+        alternates = os.path.join(info, 'alternates')
+        if os.path.exists(alternates):
+            with open(alternates) as fobj:
+                if self.objects in fobj.read().split():
+                    return
+        with open(alternates, 'a') as fobj:
+            fobj.write(self.objects + '\n')
+
+
+class RefCache(object):
+    '''
+    B{RefCache}
+    Every ref of a remote, looked up with a single git ls-remote
+    the first time any controller asks about the uri and shared
+    for the rest of the run. With a ttl the refs are also kept in
+    a json file so back to back commands skip the lookup.
+    @param path: path to the json file
+    @type path: C{string}
+    @keyword ttl: seconds refs from the file are trusted,
+                  0 keeps them for the run only
+    @type ttl: C{int}
+    '''
+
+    def __init__(self, path, ttl=0):
+        self.path = path
+        self.ttl = ttl
+        self.refs = {}
+        self._lock = threading.Lock()
+        self._uriLocks = {}
+
+    def _uriLock(self, uri):
+        self._lock.acquire()
+        try:
+            return self._uriLocks.setdefault(uri, threading.Lock())
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as fobj:
+                return json.load(fobj)
+        except (IOError, ValueError), err:
+            log.warn('Ignoring unreadable ref cache %s : %s', self.path, err)
+            return {}
+
+    def _save(self, uri, refs):
+        '''merge the refs of uri into the file atomically'''
+        self._lock.acquire()
+        try:
+            entries = self._load()
+            entries[uri] = {'time': time.time(), 'refs': refs}
+            dirname = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.refs')
+            with os.fdopen(fd, 'w') as fobj:
+                json.dump(entries, fobj, indent=1, sort_keys=True)
+            os.rename(tmp, self.path)
+        finally:
+            self._lock.release()
+
+    def _stored(self, uri):
+        '''@return: refs of uri from the file if they are recent enough'''
+        if not self.ttl:
+            return None
+        self._lock.acquire()
+        try:
+            entry = self._load().get(uri)
+        finally:
+            self._lock.release()
+        if entry and time.time() - entry['time'] < self.ttl:
+            log.debug('Using refs of %s from %s', uri, self.path)
+            return entry['refs']
+        return None
+
+    def get(self, uri):
+        '''@return: dict of ref name to commit for every ref of uri'''
+        lock = self._uriLock(uri)
+        lock.acquire()
+        try:
+            if uri not in self.refs:
+                refs = self._stored(uri)
+                if refs is None:
+                    refs = GitCommands().ls_remote(uri)
+                    if self.ttl:
+                        self._save(uri, refs)
+                self.refs[uri] = refs
+            return self.refs[uri]
+        finally:
+            lock.release()
+
+    def heads(self, uri, branch=None):
+        '''
+        @return: refs of uri matching branch the way
+                 git ls-remote uri branch matches them
+        '''
+        refs = self.get(uri)
+        if not branch:
+            return dict(refs)
+        return dict([ (x, y) for x, y in refs.items()
+                        if x == branch or x.endswith('/' + branch) ])
+
+
+_refCaches = {}
+_refCachesLock = threading.Lock()
+
+
+def getRefCache(cache, ttl=0):
+    '''@return: the C{RefCache} kept in the cache directory'''
+    path = os.path.join(cache, REFS_FILE)
+    _refCachesLock.acquire()
+    try:
+        if path not in _refCaches:
+            _refCaches[path] = RefCache(path, ttl)
+        return _refCaches[path]
+    finally:
+        _refCachesLock.release()
+
+
+def resetRefCaches():
+    '''
+    forget the refs listed so far so the next run lists them again,
+    refs kept on disk are still reused until gitRefsTTL passes
+    '''
+    _refCachesLock.acquire()
+    try:
+        _refCaches.clear()
+    finally:
+        _refCachesLock.release()
+
+
+class GitRepository(scm.ScmRepository):
+    '''
+    Bare cache of a git repository
+    @keyword depth: only fetch this many commits of history
+    @keyword filter: partial clone filter, blob:none or tree:0,
+                     missing objects are fetched when git needs them
+    @keyword pool: directory of an C{ObjectPool} to borrow objects from,
+                   depth and filter do not apply to pooled caches
+    '''
+
+    MANIFEST = '.manifest'
+    REMOTE = 'origin'
+    # Deepen a shallow cache at most this far looking for a revision
+    # before fetching all of the history
+    MAX_DEPTH = 4096
+
+    def __init__(self, uri, branch, cache='_cache', depth=0, filter=None,
+                 pool=None):
         self.uri = uri
         self.branch = branch
+        self.depth = depth
+        self.filter = filter
+        self.pool = pool and ObjectPool(pool)
         self.path = self.uri.split('//', 1)[-1]
         self.path = self.path.replace('/', '_')
         self.repo_dir = os.path.join(cache, self.path, 'git')
+        self.catFile = CatFile(self.repo_dir)
 
     def isLocal(self):
         return self.uri.startswith('/') or self.uri.startswith('file:')
@@ -195,7 +480,105 @@ class GitRepository(scm.ScmRepository):
         self.revision = self.readTip(filename)
         return self.revision
         
-    def updateCache(self):
+    def _git(self, *args):
+        '''run git in the cache repo'''
+        return GitCommands().run_git(['git'] + list(args), self.repo_dir)
+
+    def _hasCommit(self, revision):
+        p = subprocess.Popen(
+            ['git', 'cat-file', '-e', revision + '^{commit}'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.repo_dir,
+            )
+        p.communicate()
+        return not p.returncode
+
+    def _setRemote(self):
+        '''
+        point the origin remote at the uri, partial clones
+        need a named promisor remote to fetch missing objects from
+        '''
+        remotes = self._git('remote').split()
+        if self.REMOTE in remotes:
+            self._git('remote', 'set-url', self.REMOTE, self.uri)
+        else:
+            self._git('remote', 'add', self.REMOTE, self.uri)
+        if self.filter:
+            self._git('config', 'core.repositoryformatversion', '1')
+            self._git('config', 'extensions.partialClone', self.REMOTE)
+            self._git('config', 'remote.%s.promisor' % self.REMOTE, 'true')
+            self._git('config', 'remote.%s.partialclonefilter' % self.REMOTE,
+                      self.filter)
+
+    def _fetch(self, *refs, **kwargs):
+        cmd = ['fetch', '-q']
+        if self.filter:
+            cmd.append('--filter=' + self.filter)
+        cmd.extend(kwargs.get('options', []))
+        cmd.append(self.REMOTE)
+        cmd.extend(refs)
+        self._git(*cmd)
+
+    def _ensureRevision(self):
+        '''
+        make sure a pinned revision is in a shallow cache,
+        asking for it directly and then deepening the history
+        '''
+        if not self.revision or self._hasCommit(self.revision):
+            return
+        log.info('%s is not in the cache of %s, fetching it',
+                 self.revision, self.uri)
+        try:
+            options = self.depth and ['--depth=%s' % self.depth] or []
+            self._fetch(self.revision, options=options)
+        except scm.ScmError, err:
+            log.debug('Unable to fetch %s directly: %s', self.revision, err)
+        # A cache without a depth of its own can still be shallow
+        # from an earlier run, start deepening from one commit so
+        # doubling gets anywhere and gives up after MAX_DEPTH
+        depth = max(self.depth, 1)
+        while not self._hasCommit(self.revision):
+            if not os.path.exists(os.path.join(self.repo_dir, 'shallow')):
+                break
+            depth *= 2
+            if depth > self.MAX_DEPTH:
+                self._fetch('+%s:%s' % (self.branch, self.branch),
+                            options=['--unshallow'])
+                break
+            self._fetch('+%s:%s' % (self.branch, self.branch),
+                        options=['--deepen=%s' % depth])
+
+    def _updateFromPool(self):
+        '''fetch into the shared pool and point the branch at it'''
+        self.pool.borrow(self.repo_dir)
+        head = self.pool.fetch(self.uri, self.branch)
+        self._git('update-ref', 'refs/heads/' + self.branch, head)
+        if self.revision and not self._hasCommit(self.revision):
+            self.pool.fetchRevision(self.uri, self.revision)
+
+    def _cached(self):
+        '''True if the cache has the branch and the pinned revision'''
+        if not os.path.isdir(os.path.join(self.repo_dir, 'refs')):
+            return False
+        return self._hasCommit(self.revision or self.branch)
+
+    def updateCache(self, maxAge=0):
+        '''
+        Refresh the cache holding its lock
+        @keyword maxAge: reuse a cache refreshed less than this
+                         many seconds ago, by any process
+        @type maxAge: C{int}
+        '''
+        with cachelock.CacheLock(os.path.dirname(self.repo_dir)) as lock:
+            lock.used()
+            if lock.fresh(maxAge) and self._cached():
+                log.debug('Reusing cache of %s refreshed %.0fs ago',
+                          self.uri, lock.age())
+                return
+            self._updateCache()
+            lock.touch()
+
+    def _updateCache(self):
         # Create the cache repo if needed.
         if not os.path.isdir(self.repo_dir):
             os.makedirs(self.repo_dir)
@@ -205,27 +588,92 @@ class GitRepository(scm.ScmRepository):
                 ['git', 'init', '-q', '--bare'],
                 cwd=self.repo_dir,
                 )
-        subprocess.check_call(
-            ['git', 'fetch', '-q', self.uri, '+%s:%s' % (
-                    self.branch, self.branch)],
-            cwd=self.repo_dir,
-            )
+        if self.pool:
+            return self._updateFromPool()
+        self._setRemote()
+        options = []
+        if self.depth:
+            options.append('--depth=%s' % self.depth)
+        self._fetch('+%s:%s' % (self.branch, self.branch), options=options)
+        self._ensureRevision()
 
     def snapshot(self, workDir, subtree):
-        p1 = subprocess.Popen(
-            ['git', 'archive', '--format=tar', self.revision, subtree], 
-            stdout=subprocess.PIPE, 
-            cwd=self.repo_dir
-            )
-
-        p2 = subprocess.Popen(['tar', '-x'], stdin=p1.stdout, cwd=workDir)
-        p1.stdout.close()  # remove ourselves from between git and tar
-        p1.wait()
-        p2.wait()
+        cmd = ['git', 'archive', '--format=tar', self.revision]
+        if subtree:
+            cmd.append(subtree)
+        p1 = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=self.repo_dir)
+        try:
+            extract.Extractor(workDir, subtree).extract(p1.stdout)
+        finally:
+            p1.stdout.close()
+            p1.wait()
         if p1.returncode:
             raise RuntimeError("git exited with status %s" % p1.returncode)
-        if p2.returncode:
-            raise RuntimeError("tar exited with status %s" % p1.returncode)
+
+    def listTree(self, subtree=None):
+        '''
+        @return: list of (path, mode, sha) of every file under subtree
+                 at the revision, read from the object store
+        '''
+        files = []
+        top = self.revision + ':' + (subtree or '')
+        stack = [(subtree or '', self.catFile.tree(top))]
+        while stack:
+            prefix, entries = stack.pop()
+            for mode, name, sha in entries:
+                path = prefix and prefix + '/' + name or name
+                if mode == '40000':
+                    stack.append((path, self.catFile.tree(sha)))
+                elif mode != '160000':
+                    files.append((path, mode, sha))
+        return files
+
+    def materialize(self, directory, subtree=None):
+        '''
+        Write the files under subtree at the revision into directory
+        straight from the object store, without git archive or tar.
+        A directory that was already written is reused.
+        @return: list of the paths written relative to directory
+        '''
+        manifest = os.path.join(directory, self.MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as fobj:
+                return json.load(fobj)
+        parent = os.path.dirname(os.path.abspath(directory))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.materialize')
+        try:
+            paths = []
+            for path, mode, sha in self.listTree(subtree):
+                dest = os.path.join(tmp, path)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                data = self.catFile.read(sha)[2]
+                if mode == '120000':
+                    os.symlink(data, dest)
+                else:
+                    with open(dest, 'wb') as fobj:
+                        fobj.write(data)
+                    if mode == '100755':
+                        os.chmod(dest, 0755)
+                paths.append(path)
+            with open(os.path.join(tmp, self.MANIFEST), 'w') as fobj:
+                json.dump(paths, fobj)
+            try:
+                os.rename(tmp, directory)
+            except OSError:
+                # Another run wrote the same revision first
+                if not os.path.exists(manifest):
+                    raise
+                shutil.rmtree(tmp)
+        except:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            raise
+        log.debug('Materialized %s files of %s into %s',
+                  len(paths), self.revision, directory)
+        return paths
 
     def setRevision(self, filename=None):
         if filename:
@@ -19,18 +19,136 @@
 Helper functions for dealing with mercurial (hg) repositories.
 '''
 
+import atexit
 import logging
 import os
+import struct
 import subprocess
+import threading
 from .. import scm
-
-from mercurial import hg, ui
-from mercurial.node import short
+from . import cachelock
 
 
 log = logging.getLogger(__name__)
 
 
+class CommandServer(object):
+    '''
+    One long lived hg serve --cmdserver pipe process running
+    commands in a repository, so each command does not pay the
+    startup cost of mercurial
+    @param repoDir: path to the repository
+    @type repoDir: C{string}
+    '''
+
+    HEADER = struct.Struct('>cI')
+
+    def __init__(self, repoDir):
+        self.repoDir = repoDir
+        self.proc = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        log.debug("(cd '%s'; hg serve --cmdserver pipe)", self.repoDir)
+        env = dict(os.environ, HGPLAIN='1', HGENCODING='UTF-8')
+        self.proc = subprocess.Popen(
+                ['hg', 'serve', '--cmdserver', 'pipe',
+                 '--config', 'ui.interactive=False'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                cwd=self.repoDir, env=env)
+        channel, hello = self._read()
+        if channel != 'o' or 'runcommand' not in hello:
+            self.close()
+            raise scm.ScmError(None, 'unexpected hg command server greeting',
+                               hello)
+
+    def _read(self):
+        '''@return: channel and data of the next message'''
+        header = self.proc.stdout.read(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            self.close()
+            raise scm.ScmError(None, 'hg command server exited',
+                               self.repoDir)
+        channel, length = self.HEADER.unpack(header)
+        if channel in 'IL':
+            # Input requests carry the wanted size, not data
+            return channel, length
+        return channel, self.proc.stdout.read(length)
+
+    def runcommand(self, *args):
+        '''
+        @return: return code, output and error output of hg args
+        '''
+        log.debug("(cd '%s'; hg %s)", self.repoDir, ' '.join(args))
+        self._lock.acquire()
+        try:
+            if self.proc is None:
+                self._start()
+            data = '\0'.join(args)
+            self.proc.stdin.write('runcommand\n')
+            self.proc.stdin.write(struct.pack('>I', len(data)) + data)
+            self.proc.stdin.flush()
+            out, err = [], []
+            while True:
+                channel, data = self._read()
+                if channel == 'o':
+                    out.append(data)
+                elif channel == 'e':
+                    err.append(data)
+                elif channel == 'r':
+                    return (struct.unpack('>i', data)[0],
+                            ''.join(out), ''.join(err))
+                elif channel in 'IL':
+                    # Nothing to prompt with, answer with end of input
+                    self.proc.stdin.write(struct.pack('>I', 0))
+                    self.proc.stdin.flush()
+                elif channel.isupper():
+                    self.close()
+                    raise scm.ScmError(None, 'unknown hg command server '
+                                       'channel %r' % channel, self.repoDir)
+        finally:
+            self._lock.release()
+
+    def run(self, *args):
+        '''
+        @return: output of hg args
+        @raise ScmError: if the command fails
+        '''
+        rc, out, err = self.runcommand(*args)
+        if rc:
+            raise scm.ScmError(rc, err, out)
+        return out
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc = None
+
+
+_servers = {}
+_serversLock = threading.Lock()
+
+
+def getCommandServer(repoDir):
+    '''@return: the C{CommandServer} of a repository'''
+    repoDir = os.path.abspath(repoDir)
+    _serversLock.acquire()
+    try:
+        if repoDir not in _servers:
+            _servers[repoDir] = CommandServer(repoDir)
+        return _servers[repoDir]
+    finally:
+        _serversLock.release()
+
+
+@atexit.register
+def _closeServers():
+    for server in _servers.values():
+        server.close()
+
+
 class HgRepository(scm.ScmRepository):
 
     def __init__(self, uri, branch, cache='_cache'):
@@ -39,30 +157,63 @@ class HgRepository(scm.ScmRepository):
         dirPath = self.uri.split('//', 1)[-1]
         dirPath = dirPath.replace('/', '_')
         self.repoDir = os.path.join(cache, dirPath, 'hg')
+        self.server = getCommandServer(self.repoDir)
 
     def isLocal(self):
         return self.uri.startswith('/') or self.uri.startswith('file:')
 
-    def getTip(self):
-        hg_ui = ui.ui()
-        if hasattr(hg, 'peer'):
-            repo = hg.peer(hg_ui, {}, self.uri)
-        else:
-            repo = hg.repository(hg_ui, self.uri)
-        return short(repo.heads()[0])
-
-    def updateCache(self):
-        # Create the cache repo if needed.
+    def _init(self):
+        '''create the cache repo, the command server runs inside it'''
         if not os.path.isdir(self.repoDir):
             os.makedirs(self.repoDir)
         if not os.path.isdir(self.repoDir + '/.hg'):
             subprocess.check_call(['hg', 'init'], cwd=self.repoDir)
-        subprocess.check_call(['hg', 'pull', '-qf', self.uri], cwd=self.repoDir)
+
+    def getTip(self):
+        '''@return: short id of the head of the branch in the remote'''
+        self._init()
+        out = self.server.run('identify', '--id',
+                              '-r', self.branch or 'default', self.uri)
+        return out.split()[0]
+
+    def _cached(self):
+        '''True if the cache has the pinned revision'''
+        if not os.path.isdir(self.repoDir + '/.hg'):
+            return False
+        if not self.revision:
+            return True
+        rc, out, err = self.server.runcommand('log', '-q',
+                                              '-r', self.revision)
+        return not rc
+
+    def updateCache(self, maxAge=0):
+        '''
+        Refresh the cache holding its lock
+        @keyword maxAge: reuse a cache refreshed less than this
+                         many seconds ago, by any process
+        @type maxAge: C{int}
+        '''
+        with cachelock.CacheLock(os.path.dirname(self.repoDir)) as lock:
+            lock.used()
+            if lock.fresh(maxAge) and self._cached():
+                log.debug('Reusing cache of %s refreshed %.0fs ago',
+                          self.uri, lock.age())
+                return
+            self._updateCache()
+            lock.touch()
+
+    def _updateCache(self):
+        # Create the cache repo if needed.
+        self._init()
+        self.server.run('pull', '-qf', self.uri)
 
     def snapshot(self, workDir, subtree):
-        subprocess.check_call(['hg', 'archive', '--type=files',
-            '--rev', self.revision, '--include', subtree,
-            workDir], cwd=self.repoDir)
+        # The server runs in the cache repo, not our working directory
+        args = ['archive', '--type=files', '--rev', self.revision]
+        if subtree:
+            args.extend(['--include', subtree])
+        args.append(os.path.abspath(workDir))
+        self.server.run(*args)
 
     def getAction(self, extra=''):
         return 'addMercurialSnapshot(%r, tag=%r%s)' % (self.uri,
@@ -0,0 +1,168 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+'''
+Minimal inotify bindings for watching a tree of plans
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+
+logger = logging.getLogger(__name__)
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT = struct.Struct('iIII')
+# Seconds without events that end a burst of changes
+QUIET = 0.2
+
+_libc = None
+
+
+def _getLibc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        _libc = libc
+    return _libc
+
+
+def available():
+    '''@return: True if inotify can be used'''
+    try:
+        _getLibc()
+    except OSError:
+        return False
+    return True
+
+
+class Watcher(object):
+    '''
+    B{Watcher}
+    Watch every directory under top with inotify and report
+    which paths changed. Directories created later are watched
+    as they appear.
+    @param top: directory to watch
+    @type top: C{string}
+    '''
+
+    def __init__(self, top):
+        self.top = os.path.abspath(top)
+        self.libc = _getLibc()
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.dirs = {}
+        self._addTree(self.top)
+
+    def _add(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, directory,
+                                         WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # Removed before we got to it
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, '%s : %s' % (directory, os.strerror(err)))
+        self.dirs[wd] = directory
+
+    def _addTree(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            self._add(dirpath)
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.top)
+
+    def _events(self, timeout):
+        '''
+        @return: list of (wd, mask, name) read within timeout seconds
+        '''
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def read(self, timeout=None):
+        '''
+        wait for changes and collect them until things are quiet
+        @keyword timeout: seconds to wait for the first change,
+                          None waits forever
+        @return: set of changed paths relative to top, None if events
+                 were lost and everything must be rescanned
+        '''
+        changed = set()
+        lost = False
+        events = self._events(timeout)
+        while events:
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    lost = True
+                    continue
+                directory = self.dirs.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.dirs[wd]
+                    continue
+                path = os.path.join(directory, name) if name else directory
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._addTree(path)
+                changed.add(self._relative(path))
+            events = self._events(QUIET)
+        if lost:
+            logger.warn('Lost inotify events watching %s' % self.top)
+            return None
+        return changed
+
+    def close(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
@@ -19,17 +19,138 @@
 Helper functions for dealing with local (bare files) repositories.
 '''
 
+import errno
+import fcntl
+import hashlib
+import json
 import logging
 import os
-import subprocess
+import shutil
+import stat
+import tempfile
+import time
 from conary.lib import util as conary_util
 from .. import scm
+from . import inotify
 
 
 log = logging.getLogger(__name__)
 
+# ioctl cloning a whole file on copy on write filesystems,
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+COPY = 'copy'
+# Errors telling a method does not work on this filesystem at all,
+# anything else only makes the one file fall back
+UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP)
+
+
+class TreeCloner(object):
+    '''
+    B{TreeCloner}
+    Snapshot a directory tree into a read only copy without
+    duplicating file contents when the filesystem allows it.
+    Files are reflinked (copy on write clones) where supported, else
+    copied. Source files that are already read only are hard linked
+    instead, a writable source would share its inode with the snapshot
+    so edits in place on either side would show up in the other.
+    A method the filesystem does not support is dropped for the rest
+    of the tree, other errors only make that one file fall back.
+    Write permission is removed from reflinked and copied files,
+    directories stay writable so the snapshot can be removed like
+    any other directory.
+    '''
+
+    METHODS = (REFLINK, HARDLINK, COPY)
+
+    def __init__(self):
+        self.disabled = set()
+        self.counts = dict([ (x, 0) for x in self.METHODS ])
+
+    @staticmethod
+    def _reflink(src, dst):
+        with open(src, 'rb') as sobj:
+            with open(dst, 'wb') as dobj:
+                fcntl.ioctl(dobj.fileno(), FICLONE, sobj.fileno())
+        shutil.copystat(src, dst)
+
+    def _methods(self, src):
+        '''@return: methods to try for src, best first'''
+        methods = [ x for x in self.METHODS if x not in self.disabled ]
+        if os.stat(src).st_mode & 0222 and HARDLINK in methods:
+            methods.remove(HARDLINK)
+        if COPY not in methods:
+            methods.append(COPY)
+        return methods
+
+    def _file(self, src, dst):
+        '''clone one file with the best method that works'''
+        for method in self._methods(src):
+            try:
+                if method == REFLINK:
+                    self._reflink(src, dst)
+                elif method == HARDLINK:
+                    os.link(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+                break
+            except (IOError, OSError), err:
+                if method == COPY:
+                    raise
+                log.debug('Unable to %s %s : %s', method, src, err)
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                if err.errno in UNSUPPORTED:
+                    self.disabled.add(method)
+        if method != HARDLINK:
+            mode = stat.S_IMODE(os.lstat(dst).st_mode)
+            os.chmod(dst, mode & ~0222)
+        self.counts[method] += 1
+
+    def clone(self, src, dst):
+        '''
+        snapshot the contents of directory src into dst
+        @return: self, with counts of the files per method
+        '''
+        start = time.time()
+        if not os.path.isdir(src):
+            raise RuntimeError('%s does not exist or is not a directory'
+                               % src)
+        for dirpath, dirnames, filenames in os.walk(src):
+            target = os.path.join(dst, os.path.relpath(dirpath, src))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                dest = os.path.join(target, name)
+                if os.path.lexists(dest) and not os.path.isdir(dest):
+                    os.unlink(dest)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), dest)
+                elif os.path.isfile(path):
+                    self._file(path, dest)
+        log.debug('Snapshot of %s into %s in %.1fs: %s', src, dst,
+                  time.time() - start,
+                  ', '.join([ '%s %s' % (self.counts[x], x)
+                                for x in self.METHODS ]))
+        return self
+
 
 class LocalRepository(scm.ScmRepository):
+    '''
+    Plain directory of files. The revision is a digest of the
+    contents of the tree, computed from a manifest of every file
+    that only rehashes files whose size or modification time changed.
+    The manifest of the last run is kept in the cache to tell which
+    files changed since then.
+    '''
+
+    MANIFEST = 'manifest.json'
+    CHUNK = 65536
+    # Seconds between scans of the tree when inotify is not available
+    POLL = 2
 
     def __init__(self, uri, branch, cache='_cache'):
         self.uri = uri
@@ -38,6 +159,9 @@ class LocalRepository(scm.ScmRepository):
         dirPath = dirPath.replace('/', '_')
         self.repoDir = os.path.join(cache, dirPath, 'local')
         conary_util.mkdirChain(self.repoDir)
+        self.current = None
+        self.saved = None
+        self.watcher = None
 
 
     def isLocal(self):
@@ -48,8 +172,135 @@ class LocalRepository(scm.ScmRepository):
             return os.path.abspath(self.uri)
         return self.uri
 
+    def _load(self):
+        '''@return: manifest saved by the last run'''
+        if self.saved is None:
+            path = os.path.join(self.repoDir, self.MANIFEST)
+            self.saved = {}
+            if os.path.exists(path):
+                try:
+                    with open(path) as fobj:
+                        self.saved = json.load(fobj)
+                except (IOError, ValueError), err:
+                    log.warn('Ignoring unreadable manifest %s : %s',
+                             path, err)
+        return self.saved
+
+    def _entry(self, name, path, previous):
+        '''@return: size, mtime and digest of one file'''
+        st = os.lstat(path)
+        old = previous.get(name)
+        if old and old[0] == st.st_size and old[1] == st.st_mtime:
+            return old
+        digest = hashlib.sha1()
+        if stat.S_ISLNK(st.st_mode):
+            digest.update(os.readlink(path))
+        else:
+            with open(path, 'rb') as fobj:
+                while True:
+                    data = fobj.read(self.CHUNK)
+                    if not data:
+                        break
+                    digest.update(data)
+        return [st.st_size, st.st_mtime, digest.hexdigest()]
+
+    def scan(self, paths=None):
+        '''
+        Bring the manifest of the tree up to date
+        @keyword paths: paths relative to the tree known to have
+                        changed, only these are looked at once
+                        the tree has been scanned
+        @return: dict of path to [size, mtime, sha1] for every file
+        '''
+        previous = self.current
+        if previous is None:
+            previous = self._load()
+        if paths is None or self.current is None or '.' in paths:
+            manifest = {}
+            paths = ['.']
+        else:
+            manifest = dict(self.current)
+            for name in manifest.keys():
+                for path in paths:
+                    if name == path or name.startswith(path + '/'):
+                        del manifest[name]
+                        break
+        for top in paths:
+            path = os.path.join(self.uri, top)
+            if os.path.islink(path) or os.path.isfile(path):
+                manifest[os.path.normpath(top)] = self._entry(
+                                        os.path.normpath(top), path, previous)
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    full = os.path.join(dirpath, filename)
+                    name = os.path.relpath(full, self.uri)
+                    try:
+                        manifest[name] = self._entry(name, full, previous)
+                    except (IOError, OSError):
+                        # Removed while we were looking
+                        continue
+                for dirname in dirnames:
+                    full = os.path.join(dirpath, dirname)
+                    if os.path.islink(full):
+                        name = os.path.relpath(full, self.uri)
+                        manifest[name] = self._entry(name, full, previous)
+        self.current = manifest
+        return manifest
+
+    @staticmethod
+    def diff(old, new):
+        '''@return: sorted paths added, removed or changed from old to new'''
+        return sorted([ x for x in set(old) | set(new)
+                        if x not in old or x not in new
+                        or old[x][2] != new[x][2] ])
+
     def getTip(self):
-        pass
+        '''@return: digest of the contents of the tree'''
+        if self.current is None or self.watcher is None:
+            self.scan()
+        digest = hashlib.sha1()
+        for name in sorted(self.current):
+            digest.update('%s\0%s\n' % (name, self.current[name][2]))
+        return digest.hexdigest()
+
+    def changes(self):
+        '''
+        @return: paths that changed since the last call, in this
+                 or an earlier run
+        '''
+        if self.current is None:
+            self.scan()
+        changed = self.diff(self._load(), self.current)
+        fd, tmp = tempfile.mkstemp(dir=self.repoDir, prefix='.manifest')
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(self.current, fobj)
+        os.rename(tmp, os.path.join(self.repoDir, self.MANIFEST))
+        self.saved = dict(self.current)
+        return changed
+
+    def watch(self, timeout=None):
+        '''
+        Wait for files in the tree to change
+        @keyword timeout: seconds to wait, None waits forever
+        @return: sorted paths whose contents changed, touched
+                 files with the same contents are left out
+        '''
+        if not inotify.available():
+            # Compare whole scans, starting from the last one
+            # so changes made since are not missed
+            before = self.current
+            if before is None:
+                before = self.scan()
+            time.sleep(self.POLL if timeout is None
+                       else min(timeout, self.POLL))
+            return self.diff(before, self.scan())
+        if self.watcher is None:
+            self.watcher = inotify.Watcher(self.uri)
+            self.scan()
+        before = self.current
+        self.scan(self.watcher.read(timeout))
+        return self.diff(before, self.current)
 
     def updateCache(self):
         pass
@@ -62,18 +313,7 @@ class LocalRepository(scm.ScmRepository):
         path = self.uri
         if subtree:
             path = os.path.join(self.uri, subtree)
-        p1 = subprocess.Popen(['tar', '-c', '-C', path, '.'],
-                                stdout=subprocess.PIPE, 
-                                cwd=self.repoDir)
-
-        p2 = subprocess.Popen(['tar', '-x'], stdin=p1.stdout, cwd=workDir)
-        p1.stdout.close()  # remove ourselves from between tar and tar
-        p1.wait()
-        p2.wait()
-        if p1.returncode:
-            raise RuntimeError("tar exited with status %s" % p1.returncode)
-        if p2.returncode:
-            raise RuntimeError("tar exited with status %s" % p1.returncode)
+        TreeCloner().clone(path, workDir)
 
 
     def getAction(self, extra=''):
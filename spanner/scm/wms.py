@@ -1,17 +1,244 @@
+import hashlib
+import json
 import urllib
-import subprocess
 import os
+import tempfile
+import threading
+import time
 
-from conary.lib.http.http_error import ResponseError
-from conary.lib.http.opener import URLOpener
 from conary.lib.util import copyfileobj
 
+from spanner import scheduler
 from spanner import scm
+from spanner.scm import compression
+from spanner.scm import connpool
+from spanner.scm import extract
+from spanner.scm.archive import getArchiveCache, TeeReader
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Tips polled during this run keyed by poll uri, shared by every
+# WmsRepository so each repo and branch is polled at most once
+_tips = {}
+_tipsLock = threading.Lock()
+
+LOCATOR_FILE = 'wms-locators.json'
+# Repos almost never move to another git server
+LOCATOR_TTL = 7 * 24 * 3600
+LOCATOR_THREADS = 8
+POLL_DIR = 'wms-poll'
+CHUNK = 65536
+# Answers of servers that can not produce an archive format
+REFUSED = (400, 404, 406, 415, 501)
+
+# (wms base, suffix) of compressed archives a server does not serve
+_refused = set()
+_refusedLock = threading.Lock()
+
+
+class LocatorCache(object):
+    '''
+    B{LocatorCache}
+    Git uri WMS answered for each show_url locator, memoized for
+    the run and kept in a json file so later runs can skip the lookup
+    @param path: path to the json file
+    @type path: C{string}
+    @keyword ttl: seconds an answer is trusted
+    @type ttl: C{int}
+    '''
+
+    def __init__(self, path, ttl=LOCATOR_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.dirty = False
+        self._lock = threading.Lock()
+        self.uris = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as fobj:
+                return json.load(fobj)
+        except (IOError, ValueError), err:
+            logger.warn('Ignoring unreadable locator cache %s : %s' %
+                        (self.path, err))
+            return {}
+
+    def get(self, locator):
+        '''@return: cached uri of locator or None'''
+        self._lock.acquire()
+        try:
+            entry = self.uris.get(locator)
+        finally:
+            self._lock.release()
+        if entry and time.time() - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def set(self, locator, uri):
+        self._lock.acquire()
+        try:
+            self.uris[locator] = (uri, time.time())
+            self.dirty = True
+        finally:
+            self._lock.release()
+
+    def save(self):
+        '''merge our answers into the file atomically'''
+        self._lock.acquire()
+        try:
+            if not self.dirty:
+                return
+            uris = self._load()
+            uris.update(self.uris)
+            dirname = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.locators')
+            with os.fdopen(fd, 'w') as fobj:
+                json.dump(uris, fobj, indent=1, sort_keys=True)
+            os.rename(tmp, self.path)
+            self.uris = uris
+            self.dirty = False
+        finally:
+            self._lock.release()
+
+
+_locators = {}
+_polls = {}
+_cachesLock = threading.Lock()
+
+
+class PollCache(object):
+    '''
+    B{PollCache}
+    Last body of each poll uri together with the validators the
+    server sent for it, so polls can be made conditional.
+    Each uri is polled at most once per run.
+    @param directory: where poll bodies are kept
+    @type directory: C{string}
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.bodies = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _path(self, uri):
+        return os.path.join(self.directory,
+                            hashlib.sha1(uri).hexdigest() + '.json')
+
+    def _load(self, uri):
+        path = self._path(uri)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as fobj:
+                return json.load(fobj)
+        except (IOError, ValueError), err:
+            logger.warn('Ignoring unreadable poll cache %s : %s' % (path, err))
+            return {}
+
+    def _save(self, uri, entry):
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.poll')
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(entry, fobj)
+        os.rename(tmp, self._path(uri))
+
+    def fetch(self, opener, uri):
+        '''
+        @return: body of the poll uri, from the cache when the
+                 server answers 304 Not Modified
+        '''
+        self._lock.acquire()
+        try:
+            lock = self._locks.setdefault(uri, threading.Lock())
+        finally:
+            self._lock.release()
+        lock.acquire()
+        try:
+            if uri not in self.bodies:
+                self.bodies[uri] = self._fetch(opener, uri)
+            return self.bodies[uri]
+        finally:
+            lock.release()
+
+    def _fetch(self, opener, uri):
+        entry = self._load(uri)
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('modified'):
+            headers['If-Modified-Since'] = entry['modified']
+        response = opener.open(uri, headers=headers)
+        body = response.read()
+        response.close()
+        if response.status == 304 and 'body' in entry:
+            logger.debug('%s not modified' % uri)
+            return entry['body'].encode('utf8')
+        etag = response.getheader('etag')
+        modified = response.getheader('last-modified')
+        if etag or modified:
+            self._save(uri, {'etag': etag, 'modified': modified,
+                             'body': body.decode('utf8'),
+                             'time': time.time()})
+        return body
+
+
+def getPollCache(cache):
+    '''@return: the C{PollCache} kept in the cache directory'''
+    directory = os.path.join(cache, POLL_DIR)
+    _cachesLock.acquire()
+    try:
+        if directory not in _polls:
+            _polls[directory] = PollCache(directory)
+        return _polls[directory]
+    finally:
+        _cachesLock.release()
+
+
+def getLocatorCache(cache):
+    '''@return: the C{LocatorCache} kept in the cache directory'''
+    path = os.path.join(cache, LOCATOR_FILE)
+    _cachesLock.acquire()
+    try:
+        if path not in _locators:
+            _locators[path] = LocatorCache(path)
+        return _locators[path]
+    finally:
+        _cachesLock.release()
+
+
+def resetPolls():
+    '''
+    forget the tips and poll answers of this run so the next run
+    polls again, the validators kept on disk still make the polls
+    conditional
+    '''
+    _tipsLock.acquire()
+    try:
+        _tips.clear()
+    finally:
+        _tipsLock.release()
+    _cachesLock.acquire()
+    try:
+        for locators in _locators.values():
+            locators.save()
+        _locators.clear()
+        _polls.clear()
+    finally:
+        _cachesLock.release()
+
 
 class WmsRepository(scm.ScmRepository):
 
@@ -21,9 +248,12 @@ class WmsRepository(scm.ScmRepository):
             'uri',
             )
 
-    def __init__(self, base, path, branch=None):
+    def __init__(self, base, path, branch=None, cache='_cache',
+                 archiveMaxSize=None):
         self.base = base
         self.path = path
+        self.cache = cache
+        self.archiveMaxSize = archiveMaxSize
         # FIXME Hardcoded default ot master for now
         self.branch = branch or 'master'
         self.pathq = None
@@ -37,11 +267,24 @@ class WmsRepository(scm.ScmRepository):
         #self.repos = self.base + '/api/repos/' + self.pathq
         self.locator = self.repos + '/' + 'show_url'
         self.archive = self.repos + '/archive'
-        self.opener = URLOpener(followRedirects=True)
+        self.opener = connpool.getPool()
         if self.branch:
             self.poll = self.repos + '/poll/' + self._quote(self.branch)
-        if not self.revision:
-            self.setRevision()
+
+    def _getRevision(self):
+        # Looked up on first use so repos that are pinned or never
+        # asked for their revision cost no round trip
+        if self._revision is None and self.poll:
+            self.setFromTip()
+        return self._revision
+
+    def _setRevision(self, revision):
+        self._revision = revision
+        # WMS only hands out full commit ids
+        if revision:
+            self.revIsExact = True
+
+    revision = property(_getRevision, _setRevision)
 
     def settag(self, tag):
         self.tag = tag
@@ -67,6 +310,21 @@ class WmsRepository(scm.ScmRepository):
     def fetch(self, uri):
         return self.opener.open(uri).read()
 
+    def fetchPoll(self, uri=None):
+        '''
+        @return: lines of a poll uri, polled conditionally
+                 and at most once per run
+        '''
+        data = getPollCache(self.cache).fetch(self.opener, uri or self.poll)
+        return [ x for x in data.decode('utf8').split('\n') if x ]
+
+    def pollFingerprint(self):
+        '''
+        @return: digest of the poll of the repo, which lists the
+                 head of every repo in a forest
+        '''
+        return hashlib.sha1(self.fetchRevisions()).hexdigest()
+
     def _findTip(self, revisions):
         for result in revisions:
             path, branch, tip = result.split()
@@ -75,13 +333,29 @@ class WmsRepository(scm.ScmRepository):
         assert len(tip) == 40
         return branch, tip
 
+    def _pollTip(self):
+        '''
+        @return: branch and tip of the repo, polled once per run
+        '''
+        _tipsLock.acquire()
+        try:
+            entry = _tips.setdefault(self.poll, [threading.Lock(), None])
+        finally:
+            _tipsLock.release()
+        lock = entry[0]
+        lock.acquire()
+        try:
+            if entry[1] is None:
+                entry[1] = self._findTip(self.fetchPoll(self.poll))
+            return entry[1]
+        finally:
+            lock.release()
+
     def getTip(self):
-        revisions = self.fetchlines(self.poll)
-        return self._findTip(revisions)[1]
+        return self._pollTip()[1]
 
     def setFromTip(self):
-        revisions = self.fetchlines(self.poll)
-        branch, tip = self._findTip(revisions)
+        branch, tip = self._pollTip()
         # FIXME Not sure we should set branch here
         # might be safer to check the branch
         # assert self.branch == branch
@@ -104,9 +378,37 @@ class WmsRepository(scm.ScmRepository):
 
     def getGitUri(self):
         #FIXME might need to append .git
-        result = self.fetchlines(self.locator)
-        assert len(result) == 1
-        return result[0]
+        return self.getLocation(self.locator)
+
+    def getLocation(self, locator):
+        '''
+        @return: git uri of a show_url locator
+        '''
+        locators = getLocatorCache(self.cache)
+        uri = locators.get(locator)
+        if uri is None:
+            result = self.fetchlines(locator)
+            assert len(result) == 1
+            uri = result[0]
+            locators.set(locator, uri)
+        return uri
+
+    def getLocations(self, locators):
+        '''
+        look up the git uri of every locator not cached yet
+        concurrently and save the answers
+        '''
+        cache = getLocatorCache(self.cache)
+        missing = sorted(set([ x for x in locators if cache.get(x) is None ]))
+        if missing:
+            logger.debug('Looking up %s repository locations' % len(missing))
+            pool = scheduler.BuildScheduler(jobs=LOCATOR_THREADS)
+            for locator in missing:
+                pool.add(locator, self.getLocation, locator)
+            for job in pool.run():
+                if job.error is not None:
+                    raise job.error
+            cache.save()
 
     def readRevisions(self, filename):
         blob = ''
@@ -121,7 +423,13 @@ class WmsRepository(scm.ScmRepository):
     def fetchRevisions(self, uri=None):
         if not uri and self.poll:
             uri = self.poll
-        return self.fetch(uri)
+        return getPollCache(self.cache).fetch(self.opener, uri)
+
+    def _locatorOf(self, fl):
+        path = fl.split()[0]
+        silo, subpath = path.split('/', 1)
+        pathq = self._quote(silo) + '/' + self._quote(subpath)
+        return self.base + '/api/repos/' + pathq + '/' + 'show_url'
 
     def parseRevisionsLine(self, fl):
         path, branch, head = fl.split()
@@ -131,12 +439,13 @@ class WmsRepository(scm.ScmRepository):
         repos = self.base + '/api/repos/' + pathq
         poll = repos + '/poll/' + self._quote(branch)
         locator = repos + '/' + 'show_url'
-        uri = self.fetchlines(locator)[0]
+        uri = self.getLocation(locator)
         return name, silo, branch, head, path, pathq, repos, poll, locator, uri
         
     def parseRevisions(self, blob):
         data = {}
         filelines = [ x for x in blob.split('\n') if x]
+        self.getLocations([ self._locatorOf(x) for x in filelines ])
         for fl in filelines:
             info = self.parseRevisionsLine(fl)    
             data.setdefault(info[0], {}).update(dict(zip(self.TAGS,info)))
@@ -160,28 +469,81 @@ class WmsRepository(scm.ScmRepository):
                 + '-' + self.getShortRev()
                 + '.tar' + compress)
 
+    def _openArchive(self, archive, data=None):
+        '''
+        open an archive of the revision asking for the compressed
+        variants first and falling back to the plain tar
+        @param archive: quoted name of the archive
+        @return: the response and a decompressor for it
+        '''
+        url = self.repos + '/archive/' + urllib.quote(self.revision) + '/'
+        suffixes = ['']
+        if archive.endswith('.tar'):
+            _refusedLock.acquire()
+            try:
+                suffixes = [ x for x in compression.suffixes()
+                                if (self.base, x) not in _refused ]
+            finally:
+                _refusedLock.release()
+        failed = []
+        for suffix in suffixes:
+            try:
+                f = self.opener.open(url + archive + suffix, data=data)
+            except scm.ScmError, err:
+                if not suffix or err.args[0] not in REFUSED:
+                    raise
+                failed.append(suffix)
+                continue
+            # Only remembered once another variant worked, so a
+            # missing archive does not disable compression
+            _refusedLock.acquire()
+            try:
+                for refused in failed:
+                    logger.debug('%s does not serve %s archives' %
+                                 (self.base, refused))
+                    _refused.add((self.base, refused))
+            finally:
+                _refusedLock.release()
+            return f, compression.decompressor(suffix)
+
+    def _stream(self, archive, data=None):
+        '''
+        @return: file like object reading the decompressed archive
+        '''
+        f, decompressor = self._openArchive(archive, data)
+        return compression.Reader(f, decompressor, CHUNK)
+
     def snapshot(self, workDir, subtree=None):
         '''
         http://wheresmystuff.unx.sas.com/api/repos/gerrit-pdt/tools:build-tools/archive/78eed1cae30790e65ee599b04f93f23e93b84641/build-tools.tar
         Need to parseRevisionLine and extract the head
         then download the head and explode it into the workDir
+        Archives of exact revisions are served from the archive cache
         '''
         archive = self._archive()
-        data = urllib.urlencode([('subtree', subtree)]) if subtree else None
-        f = self.opener.open(self.repos + '/archive/'
-                    + urllib.quote(self.revision) + '/' + archive, data=data)
-        tar = subprocess.Popen(['tar', '-x'], stdin=subprocess.PIPE,
-                cwd=workDir)
-        while True:
-            d = f.read(10000)
-            if not d:
-                break
-            tar.stdin.write(d)
-        tar.stdin.close()
-        tar.wait()
-        if tar.returncode:
-            raise RuntimeError("tar exited with status %s" % tar.returncode)
         prefix = archive.rsplit('.', 1)[0]
+        cache = getArchiveCache(self.cache, self.archiveMaxSize)
+        key = cache.key(self.path, self.revision, subtree, archive)
+        cached = cache.get(key)
+        writer = None
+        if cached:
+            f = open(cached, 'rb')
+        else:
+            data = urllib.urlencode([('subtree', subtree)]) if subtree else None
+            f = self._stream(archive, data=data)
+            writer = key and cache.open(key)
+            if writer:
+                f = TeeReader(f, writer)
+        try:
+            extract.Extractor(workDir, subtree, prefix).extract(f)
+        except:
+            if writer:
+                writer.abort()
+            raise
+        finally:
+            f.close()
+        if writer:
+            writer.commit()
         return prefix
 
     def getAction(self, extra=''):
@@ -195,12 +557,21 @@ class WmsRepository(scm.ScmRepository):
         if os.path.exists(snapPath):
             return
         archive = urllib.quote(os.path.basename(snapPath))
-        url = (self.repos + '/archive/'
-                + urllib.quote(self.revision) + '/' + archive)
-        f_in = self.opener.open(url)
-        with open(snapPath, 'w') as f_out:
-            copyfileobj(f_in, f_out)
-        f_in.close()
+        cache = getArchiveCache(self.cache, self.archiveMaxSize)
+        key = cache.key(self.path, self.revision, None, archive)
+        if key and cache.get(key):
+            cache.copy(key, snapPath)
+            return
+        f_in = self._stream(archive)
+        try:
+            if key:
+                cache.put(key, f_in)
+                cache.copy(key, snapPath)
+            else:
+                with open(snapPath, 'w') as f_out:
+                    copyfileobj(f_in, f_out)
+        finally:
+            f_in.close()
 
     def setRevision(self, rev=None, filename=None):
         if filename:
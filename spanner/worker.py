@@ -23,12 +23,18 @@ import os
 import time
 
 
+from . import cachemanager
 from . import config
+from . import errors
 from . import fetcher
 from . import reader
 from . import checker
 from . import builder
 from . import grouper
+from . import journal
+from . import scm
+from .scm import git
+from .scm import wms
 
 logger = logging.getLogger(__name__)
 
@@ -43,10 +49,14 @@ class Worker(object):
     @keyword branch: branch of the repo
     @keyword cfgfile: use alternate cfg file
     @keyword test: Boolean to toggle debug mode (no builds)
+    @keyword jobs: number of bob plans to build at once
+    @keyword explain: print the predicted build schedule and stop
+    @keyword resume: continue the unfinished work of a run that died
     '''
 
     def __init__(self, uri, force=None, branch=None, cfgfile=None, 
-                    group=False, products=False, test=False, cfg=None):
+                    group=False, products=False, test=False, cfg=None,
+                    jobs=None, explain=False, resume=False):
 
         self.uri = uri
         self.force = force or []
@@ -58,6 +68,15 @@ class Worker(object):
         self.products_build = products
         self.test = test
         self.branch = branch
+        self.jobs = jobs
+        self.explain = explain
+        self.resume = resume
+        self.journal = None
+        self.fetcher = None
+        # Files of a local control repo changed since the last
+        # run and the plans path and packageset that run checked
+        self.changed = None
+        self.previous = None
  
         if self.cfg.testOnly:
             logger.warn('testOnly set in config file ignoring commandline')
@@ -81,15 +100,42 @@ class Worker(object):
         check out plans from repo
         return destination of plans
         '''
-        fetchPlans = fetcher.Fetcher(self.uri, self.cfg, self.branch)
-        return fetchPlans.fetch()
+        return self.getFetcher().fetch()
+
+    def getFetcher(self):
+        '''return the fetcher of the control repo'''
+        if self.fetcher is None:
+            self.fetcher = fetcher.Fetcher(self.uri, self.cfg, self.branch)
+        return self.fetcher
+
+    def _options(self):
+        '''options that change what a run does besides the forest'''
+        return [bool(self.group_build), bool(self.products_build),
+                bool(self.test)]
+
+    def unchanged(self, fingerprint):
+        '''
+        True if the last run of this control repo finished cleanly
+        from the same forest with the same options
+        '''
+        if not fingerprint or not self.cfg.skipUnchanged:
+            return False
+        if self.force or self.resume or not self.journal:
+            return False
+        previous = self.journal.previous
+        return bool(previous and previous.get('clean')
+                    and previous.get('fingerprint') == fingerprint
+                    and previous.get('options') == self._options())
 
     def read(self, path):
         '''
         pass in path to plans
         return set of package objects
         '''
-        readPlans = reader.Reader(path, self.cfg)
+        files = None
+        if self.fetcher and self.fetcher.path == path:
+            files = self.fetcher.manifest
+        readPlans = reader.Reader(path, self.cfg, files)
         return readPlans.read()
 
     def check(self, plans):
@@ -105,6 +151,52 @@ class Worker(object):
                             self.force, self.branch, self.test)
         return changes.check()
 
+    def recheck(self, planpaths, plans):
+        '''
+        check again only the plans that changed since the previous
+        run of this worker, the packages of the other plans are
+        taken from the packageset of that run
+        @return: packageset, or None if every plan has to be checked
+        '''
+        if self.previous is None or self.changed is None:
+            return None
+        oldpaths, oldset = self.previous
+        sections = [ x for x in (self.cfg.projectsDir, self.cfg.externalDir,
+                                 self.cfg.productsDir) if x in plans ]
+        known = set()
+        for section in sections:
+            known.update([ os.path.relpath(x, planpaths)
+                            for x in plans[section] ])
+            known.update([ os.path.relpath(x, oldpaths)
+                            for x in oldset.get(section, {}) ])
+        if [ x for x in self.changed if x not in known ]:
+            # Files shared by the plans may have changed
+            return None
+        stale = {}
+        kept = {}
+        for section in sections:
+            for path in plans[section]:
+                name = os.path.relpath(path, planpaths)
+                old = os.path.join(oldpaths, name)
+                if name in self.changed or old not in oldset.get(section, {}):
+                    stale.setdefault(section, set()).add(path)
+                    continue
+                pkgs = oldset[section][old]
+                for pkg in pkgs:
+                    pkg.bobplan = path
+                kept.setdefault(section, {})[path] = pkgs
+        logger.info('Checking %s changed plans again' %
+                    sum([ len(x) for x in stale.values() ]))
+        changes = checker.Checker(stale, self.cfg,
+                            self.force, self.branch, self.test)
+        packageset = {}
+        if stale:
+            packageset = changes.check()
+        for section in sections:
+            packageset.setdefault(section, {}).update(
+                        changes.recheck(kept.get(section, {})))
+        return packageset
+
     def build(self, packageset, products=False):
         '''
         pass in set of package objects
@@ -113,7 +205,8 @@ class Worker(object):
         return updated set of package objects
         '''
         # builder returns set of packages updated with built flag set
-        b = builder.Builder(packageset, self.cfg, self.test)
+        b = builder.Builder(packageset, self.cfg, self.test, self.jobs,
+                            self.explain, self.journal)
         if products:
             return b.buildProducts()
         return b.buildProjects()
@@ -147,11 +240,34 @@ class Worker(object):
                     print '\tLog:\n\t\t\t%s\n' %  pkg.log
 
 
+    def _journaledPlans(self):
+        '''return the plan path of the run being resumed if still there'''
+        if not self.journal:
+            return None
+        fetched = self.journal.getPhase('fetch')
+        if fetched and os.path.isdir(fetched.get('path', '')):
+            return str(fetched['path'])
+        return None
+
+    def _finished(self, name):
+        '''True if the run being resumed finished the phase'''
+        return bool(self.journal and self.journal.getPhase(name))
+
+    def _phase(self, name, **data):
+        '''record the end of a phase in the journal'''
+        if self.journal:
+            self.journal.phase(name, **data)
+
     def getPackageSet(self):
         '''return packageset and plans'''
         start = time.time()
         print "Begin gathering planpaths : %s" % start
-        planpaths = self.fetch()
+        planpaths = self._journaledPlans()
+        if planpaths:
+            print "Resuming with plans from %s" % planpaths
+        else:
+            planpaths = self.fetch()
+            self._phase('fetch', path=planpaths)
         end = time.time() - start
         print "End gathering planpaths : %s" % end
         start = time.time()
@@ -159,11 +275,16 @@ class Worker(object):
         plans = self.read(planpaths)
         end = time.time() - start
         print "End reading plans : %s" % end
+        self._phase('read')
         start = time.time()
         print "Begin checking plans : %s" % start
-        packageset = self.check(plans)
+        packageset = self.recheck(planpaths, plans)
+        if packageset is None:
+            packageset = self.check(plans)
         end = time.time() - start
         print "End checking plans : %s" % end
+        self._phase('check')
+        self.previous = (planpaths, packageset)
         return packageset, plans
 
     def buildGroup(self, packageset=None, plans=None):
@@ -187,24 +308,100 @@ class Worker(object):
         print "End building products : %s" % end
         return packageset
          
+    def prune(self):
+        '''evict old entries from the cache and plan directories'''
+        if not self.cfg.pruneCaches or self.test:
+            return
+        try:
+            cachemanager.CacheManager(self.cfg).prune()
+        except (IOError, OSError), err:
+            logger.warn('Unable to prune the caches : %s' % err)
+
     def main(self):
         '''Main function for Worker'''
         startStart = time.time()
+        # Explaining the schedule or a dry run leaves the journal of
+        # real runs alone, resuming must not skip what was never built
+        if not self.explain and not self.test:
+            self.journal = journal.Journal.forRun(self.tmpdir, self.uri,
+                                        self.branch, resume=self.resume)
+        ctrlr = self.getFetcher().controller
+        if hasattr(ctrlr, 'changes'):
+            self.changed = ctrlr.changes()
+            if self.changed:
+                logger.info('Files changed since the last run : %s' %
+                            ' '.join(self.changed))
+        try:
+            fingerprint = self.getFetcher().fingerprint()
+        except scm.ScmError, err:
+            logger.warn('Unable to fingerprint %s : %s' % (self.uri, err))
+            fingerprint = None
+        if self.unchanged(fingerprint):
+            logger.info('Skipping the run, %s has not changed since the last '
+                        'run which built everything it tried; set '
+                        'skipUnchanged to False or force a build to run '
+                        'anyway' % self.uri)
+            print "Nothing to do, %s is unchanged since the last run" % self.uri
+            self.journal.done(fingerprint=fingerprint, options=self._options())
+            self.journal.close()
+            self.prune()
+            return
         packageset, plans = self.getPackageSet()
-        start = time.time()
-        print "Begin building projects : %s" % start
-        packageset = self.build(packageset)
-        end = time.time() - start
-        print "End building projects : %s" % end
-        start = time.time()
-        if self.group_build:
+        if self.explain:
+            self.build(packageset)
+            return
+        # Plans are read and checked again on resume, the phases
+        # after them that the interrupted run finished are skipped
+        if self._finished('projects'):
+            print "Projects were built by the interrupted run"
+        else:
+            start = time.time()
+            print "Begin building projects : %s" % start
+            packageset = self.build(packageset)
+            end = time.time() - start
+            print "End building projects : %s" % end
+            self._phase('projects')
+        if self.group_build and not self._finished('group'):
             self.buildGroup(packageset, plans)
-        if self.products_build:
+            self._phase('group')
+        if self.products_build and not self._finished('products'):
             packageset = self.buildProducts(packageset)
+            self._phase('products')
         self.display(packageset)
+        if self.journal:
+            self.journal.done(fingerprint=fingerprint,
+                              options=self._options())
+            self.journal.close()
+        self.prune()
         end = time.time() - startStart
         print "Total time : %s" % end
 
+    def watch(self):
+        '''
+        Run, then run again every time files of a local control
+        repo change, until interrupted. Only the plans that changed
+        are checked again, the other packages are kept from the
+        previous run.
+        '''
+        ctrlr = self.getFetcher().controller
+        if not hasattr(ctrlr, 'watch'):
+            raise errors.SpannerError('--watch needs a local control '
+                                      'repo, not %s' % self.uri)
+        while True:
+            # Branch heads and polls are memoized for a run, every
+            # run has to see what moved upstream since the last one
+            git.resetRefCaches()
+            wms.resetPolls()
+            self.main()
+            print "Watching %s for changes" % self.uri
+            changed = []
+            while not changed:
+                changed = ctrlr.watch()
+            print "Changed : %s" % ' '.join(changed)
+            # Snapshot again on the next run, the controller is kept
+            # so only the changed files are looked at
+            self.fetcher.reset()
+
 if __name__ == '__main__':
     import sys
     from conary.lib import util
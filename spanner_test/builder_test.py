@@ -0,0 +1,92 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from spanner import builder
+from spanner import package
+
+
+LABEL = 'example.com@ns:1'
+
+
+class Revision(object):
+    version = '1.abcdef'
+
+
+class Version(object):
+
+    def trailingLabel(self):
+        return LABEL
+
+    def trailingRevision(self):
+        return Revision()
+
+    def asString(self):
+        return '/%s/1.abcdef-1-1' % LABEL
+
+
+class BuildCache(object):
+
+    def __init__(self, troves):
+        self.troves = troves
+
+    def get(self, key):
+        return self.troves
+
+
+class Repos(object):
+
+    def hasTroves(self, troves):
+        return [True] * len(troves)
+
+
+class Client(object):
+    repos = Repos()
+
+
+class ReuseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.builder = builder.Builder.__new__(builder.Builder)
+        self.builder.buildCache = BuildCache([('a', Version(), '')])
+        self.builder._cclient = Client()
+
+    def members(self, forced=False):
+        pkg = package.Package(name='a', target='a', label=LABEL,
+                              commit='abcdef0123', planDigest='digest',
+                              bobplan='projects/a.bob', forced=forced)
+        return [('a', pkg)]
+
+    def testCachedBuildIsReused(self):
+        members = self.members()
+        self.assertTrue(self.builder._reuse(members))
+        self.assertEqual(members[0][1].revision, '1.abcdef')
+
+    def testForcedTargetIsBuilt(self):
+        members = self.members(forced=True)
+        self.assertFalse(self.builder._reuse(members))
+        self.assertEqual(members[0][1].revision, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
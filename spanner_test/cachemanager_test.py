@@ -0,0 +1,160 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from spanner import cachemanager
+from spanner.scm import cachelock
+
+DAY = cachemanager.DAY
+
+
+class Cfg(object):
+
+    def __init__(self, top, **kwargs):
+        self.cacheDir = os.path.join(top, '_cache')
+        self.planDir = os.path.join(top, '_plan')
+        self.buildCacheDir = 'builds'
+        self.buildHistoryFile = 'build-history.json'
+        self.cacheMaxAge = 0
+        self.cacheMaxSize = 0
+        self.planMaxAge = 0
+        self.archiveCacheMaxSize = 0
+        self.__dict__.update(kwargs)
+
+
+class CacheManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def make(self, path, size=10, age=0):
+        '''create a directory holding one file of size bytes'''
+        path = os.path.join(self.top, path)
+        os.makedirs(path)
+        with open(os.path.join(path, 'data'), 'w') as fobj:
+            fobj.write('x' * size)
+        self.age(path, age)
+        return path
+
+    def age(self, path, age):
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def repo(self, name, size=10, age=0):
+        path = self.make(os.path.join('_cache', name, 'git'), size)
+        path = os.path.dirname(path)
+        self.age(path, age)
+        return path
+
+    def testBuildCacheIsNotARepo(self):
+        self.make('_cache/builds/ab/abcdef', age=30 * DAY)
+        self.age(os.path.join(self.top, '_cache/builds'), 30 * DAY)
+        self.make('_cache/other', age=30 * DAY)
+        old = self.repo('old', age=30 * DAY)
+        manager = cachemanager.CacheManager(Cfg(self.top, cacheMaxAge=1))
+        self.assertEqual([ x.path for x in manager.repos() ], [old])
+        removed = manager.prune()
+        self.assertEqual([ x.path for x in removed ], [old])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.top, '_cache'))),
+                         ['builds', 'other'])
+
+    def testSizeEvictsLeastRecentlyUsed(self):
+        oldest = self.repo('a', size=600 * 1024, age=3 * DAY)
+        older = self.repo('b', size=600 * 1024, age=2 * DAY)
+        newest = self.repo('c', size=600 * 1024, age=1 * DAY)
+        manager = cachemanager.CacheManager(Cfg(self.top, cacheMaxSize=1))
+        removed = manager.prune()
+        self.assertEqual([ x.path for x in removed ], [oldest, older])
+        self.assertTrue(os.path.isdir(newest))
+
+    def testArchivesKeepTheirOwnLimit(self):
+        archives = os.path.join(self.top, '_cache', 'archives', 'ab')
+        os.makedirs(archives)
+        for name, age in (('old', 2 * DAY), ('new', DAY)):
+            path = os.path.join(archives, name)
+            with open(path, 'w') as fobj:
+                fobj.write('x' * 600 * 1024)
+            self.age(path, age)
+        repo = self.repo('a', size=600 * 1024)
+        manager = cachemanager.CacheManager(Cfg(self.top, cacheMaxSize=1,
+                                                archiveCacheMaxSize=1))
+        self.assertEqual(manager.prune(), [])
+        self.assertTrue(os.path.isdir(repo))
+        self.assertEqual(os.listdir(archives), ['new'])
+
+    def testDryRun(self):
+        old = self.repo('a', age=3 * DAY)
+        manager = cachemanager.CacheManager(Cfg(self.top, cacheMaxAge=1))
+        self.assertEqual([ x.path for x in manager.prune(dryRun=True) ],
+                         [old])
+        self.assertTrue(os.path.isdir(old))
+
+    def testSnapshots(self):
+        old = self.make('_plan/tmpold', age=10 * DAY)
+        new = self.make('_plan/tmpnew')
+        manager = cachemanager.CacheManager(Cfg(self.top, planMaxAge=7))
+        self.assertEqual([ x.path for x in manager.prune() ], [old])
+        self.assertTrue(os.path.isdir(new))
+
+    def testLockedRepoIsSkipped(self):
+        old = self.repo('a', age=3 * DAY)
+        lock = cachelock.CacheLock(old)
+        lock.__enter__()
+        try:
+            self.age(old, 3 * DAY)
+            manager = cachemanager.CacheManager(Cfg(self.top, cacheMaxAge=1))
+            self.assertEqual(manager.prune(), [])
+            self.assertTrue(os.path.isdir(old))
+        finally:
+            lock.__exit__()
+
+    def testWaiterStartsOverOnRemovedCache(self):
+        old = self.repo('a', age=3 * DAY)
+        holder = cachelock.CacheLock(old)
+        holder.__enter__()
+        got = []
+        def wait():
+            with cachelock.CacheLock(old) as lock:
+                got.append(lock._current(lock.fobj))
+                lock.touch()
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        time.sleep(0.2)
+        # What the cache manager does once it holds the lock
+        cachemanager.CacheManager._rmtree(old)
+        holder.__exit__()
+        waiter.join()
+        self.assertEqual(got, [True])
+        self.assertEqual(sorted(os.listdir(old)),
+                         [cachelock.LOCK_FILE, cachelock.STAMP_FILE])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from spanner.scm import extract
+
+
+def archive(members):
+    '''
+    @param members: list of (name, kind, link) with kind file, dir,
+                    sym or lnk
+    @return: file object holding a tar of members
+    '''
+    fobj = StringIO()
+    tar = tarfile.open(fileobj=fobj, mode='w')
+    for name, kind, link in members:
+        info = tarfile.TarInfo(name)
+        if kind == 'sym':
+            info.type = tarfile.SYMTYPE
+            info.linkname = link
+            tar.addfile(info)
+        elif kind == 'lnk':
+            info.type = tarfile.LNKTYPE
+            info.linkname = link
+            tar.addfile(info)
+        elif kind == 'dir':
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        else:
+            info.size = len(name)
+            tar.addfile(info, StringIO(name))
+    tar.close()
+    fobj.seek(0)
+    return fobj
+
+
+class ExtractorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.work = os.path.join(self.top, 'work')
+        self.outside = os.path.join(self.top, 'outside')
+        os.mkdir(self.work)
+        os.mkdir(self.outside)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def extract(self, members, subtree=None, prefix=None):
+        extractor = extract.Extractor(self.work, subtree, prefix)
+        return extractor.extract(archive(members))
+
+    def testSubtree(self):
+        result = self.extract([
+            ('repo/bob-plans', 'dir', None),
+            ('repo/bob-plans/a.bob', 'file', None),
+            ('repo/recipes/a.recipe', 'file', None),
+            ], subtree='bob-plans', prefix='repo')
+        self.assertEqual(result.files, 1)
+        self.assertEqual(result.skipped, 1)
+        self.assertTrue(os.path.isfile(
+                os.path.join(self.work, 'repo/bob-plans/a.bob')))
+
+    def testAbsoluteAndParentNames(self):
+        for name in ('/etc/a.bob', '../a.bob', 'bob-plans/../../a.bob'):
+            self.assertRaises(RuntimeError, self.extract,
+                              [(name, 'file', None)])
+
+    def testSymlinkOutside(self):
+        for link in (self.outside, '../../outside', '/tmp'):
+            self.assertRaises(RuntimeError, self.extract, [
+                ('bob-plans/esc', 'sym', link),
+                ('bob-plans/esc/pwn.txt', 'file', None),
+                ])
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def testWriteThroughSymlink(self):
+        # A link the archive did not create still must not be followed
+        os.symlink(self.outside, os.path.join(self.work, 'esc'))
+        self.assertRaises(RuntimeError, self.extract,
+                          [('esc/pwn.txt', 'file', None)])
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def testHardlinkOutside(self):
+        self.assertRaises(RuntimeError, self.extract,
+                          [('bob-plans/h', 'lnk', '../outside/x')])
+
+    def testLinksInside(self):
+        result = self.extract([
+            ('bob-plans/a.bob', 'file', None),
+            ('bob-plans/b.bob', 'sym', 'a.bob'),
+            ('bob-plans/c.bob', 'lnk', 'bob-plans/a.bob'),
+            ])
+        self.assertEqual(result.files, 1)
+        self.assertEqual(os.readlink(
+                os.path.join(self.work, 'bob-plans/b.bob')), 'a.bob')
+        self.assertTrue(os.path.isfile(
+                os.path.join(self.work, 'bob-plans/c.bob')))
+
+
+if __name__ == '__main__':
+    unittest.main()
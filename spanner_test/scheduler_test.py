@@ -0,0 +1,120 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from spanner import errors
+from spanner import scheduler
+
+
+def build(rc=0, delay=0):
+    time.sleep(delay)
+    return rc, 'bob'
+
+
+def explode():
+    raise RuntimeError('bob is gone')
+
+
+class BuildSchedulerTest(unittest.TestCase):
+
+    def pool(self, **kwargs):
+        return scheduler.BuildScheduler(
+                    failed=lambda job: job.result[0] != 0, **kwargs)
+
+    def status(self, jobs):
+        return dict([ (x.name, (x.status, x.blocked)) for x in jobs ])
+
+    def testFailureSkipsDependents(self):
+        pool = self.pool(jobs=2)
+        pool.add('a', build, 1)
+        pool.add('b', build)
+        pool.add('c', build)
+        pool.add('d', build)
+        pool.depend('b', ['a'])
+        pool.depend('c', ['b'])
+        seen = []
+        finished = pool.run(seen.append)
+        self.assertEqual(finished, seen)
+        self.assertEqual(self.status(finished), {
+                'a': (scheduler.FAILED, None),
+                'b': (scheduler.SKIPPED, 'a'),
+                'c': (scheduler.SKIPPED, 'a'),
+                'd': (scheduler.DONE, None),
+                })
+
+    def testRaisingJobFails(self):
+        pool = self.pool()
+        pool.add('a', explode)
+        pool.add('b', build)
+        pool.depend('b', ['a'])
+        finished = pool.run()
+        self.assertEqual(self.status(finished), {
+                'a': (scheduler.FAILED, None),
+                'b': (scheduler.SKIPPED, 'a'),
+                })
+        self.assertTrue(isinstance(finished[0].error, RuntimeError))
+        self.assertEqual(finished[0].result, None)
+
+    def testDeadlineSkipsPending(self):
+        pool = self.pool(deadline=time.time() - 1)
+        pool.add('a', build)
+        pool.add('b', build)
+        finished = pool.run()
+        self.assertEqual(self.status(finished), {
+                'a': (scheduler.SKIPPED, scheduler.DEADLINE),
+                'b': (scheduler.SKIPPED, scheduler.DEADLINE),
+                })
+
+    def testCycle(self):
+        pool = self.pool()
+        pool.add('a', build)
+        pool.add('b', build)
+        pool.depend('a', ['b'])
+        pool.depend('b', ['a'])
+        self.assertRaises(errors.SpannerDependencyError, pool.run)
+
+    def testBound(self):
+        lock = threading.Lock()
+        counts = {'now': 0, 'max': 0}
+        def job():
+            lock.acquire()
+            counts['now'] += 1
+            counts['max'] = max(counts['max'], counts['now'])
+            lock.release()
+            time.sleep(0.05)
+            lock.acquire()
+            counts['now'] -= 1
+            lock.release()
+            return 0, 'bob'
+        pool = self.pool(jobs=2)
+        for idx in range(6):
+            pool.add(str(idx), job)
+        finished = pool.run()
+        self.assertEqual(len(finished), 6)
+        self.assertEqual(counts['max'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from spanner.scm import local
+
+
+class TreeClonerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.src = os.path.join(self.top, 'src')
+        self.dst = os.path.join(self.top, 'dst')
+        os.makedirs(os.path.join(self.src, 'projects'))
+        self.write('projects/a.bob', 'a')
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def write(self, name, data, root=None):
+        with open(os.path.join(root or self.src, name), 'w') as fobj:
+            fobj.write(data)
+
+    def read(self, name, root=None):
+        with open(os.path.join(root or self.dst, name)) as fobj:
+            return fobj.read()
+
+    def testWritableSourceIsNotShared(self):
+        local.TreeCloner().clone(self.src, self.dst)
+        snap = os.path.join(self.dst, 'projects/a.bob')
+        self.assertFalse(os.stat(snap).st_mode & 0222)
+        self.assertNotEqual(os.stat(snap).st_ino,
+                os.stat(os.path.join(self.src, 'projects/a.bob')).st_ino)
+        # Edit the source in place
+        with open(os.path.join(self.src, 'projects/a.bob'), 'r+') as fobj:
+            fobj.write('b')
+        self.assertEqual(self.read('projects/a.bob'), 'a')
+
+    def testReadOnlySourceIsLinked(self):
+        os.chmod(os.path.join(self.src, 'projects/a.bob'), 0444)
+        cloner = local.TreeCloner()
+        cloner.disabled.add(local.REFLINK)
+        cloner.clone(self.src, self.dst)
+        self.assertEqual(cloner.counts[local.HARDLINK], 1)
+
+    def testSymlinks(self):
+        os.symlink('a.bob', os.path.join(self.src, 'projects/b.bob'))
+        local.TreeCloner().clone(self.src, self.dst)
+        self.assertEqual(os.readlink(
+                os.path.join(self.dst, 'projects/b.bob')), 'a.bob')
+
+    def testFallback(self):
+        self.write('projects/b.bob', 'b')
+        calls = []
+        def reflink(src, dst, errors=[errno.EIO, errno.EOPNOTSUPP]):
+            calls.append(src)
+            raise IOError(errors.pop(0), 'no')
+        cloner = local.TreeCloner()
+        cloner._reflink = reflink
+        cloner.clone(self.src, self.dst)
+        # A stray error does not give up on reflinks, unsupported does
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cloner.disabled, set([local.REFLINK]))
+        self.assertEqual(cloner.counts[local.COPY], 2)
+        self.assertEqual(self.read('projects/b.bob'), 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
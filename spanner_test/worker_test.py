@@ -0,0 +1,80 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from spanner import controller
+from spanner import journal
+from spanner import worker
+
+
+class Cfg(object):
+
+    def __init__(self, top, **kwargs):
+        self.cacheDir = os.path.join(top, '_cache')
+        self.skipUnchanged = True
+        self.__dict__.update(kwargs)
+
+
+class UnchangedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.plans = os.path.join(self.top, 'plans')
+        os.makedirs(os.path.join(self.plans, 'projects'))
+        with open(os.path.join(self.plans, 'projects', 'a.bob'), 'w') as fobj:
+            fobj.write('[target:a]\n')
+        self.worker = worker.Worker.__new__(worker.Worker)
+        self.worker.cfg = Cfg(self.top)
+        self.worker.force = []
+        self.worker.resume = False
+        self.worker.group_build = False
+        self.worker.products_build = False
+        self.worker.test = False
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def finish(self):
+        '''@return: fingerprint of a run that finished cleanly'''
+        ctrlr = controller.Controller.create('LOCAL', self.top, 'plans',
+                                             cfg=self.worker.cfg)
+        fingerprint = ctrlr.fingerprint()
+        path = os.path.join(self.top, 'journal.log')
+        self.worker.journal = journal.Journal(path)
+        skip = self.worker.unchanged(fingerprint)
+        self.worker.journal.done(fingerprint=fingerprint,
+                                 options=self.worker._options())
+        self.worker.journal.close()
+        return skip
+
+    def testSourceRepoMovesPlanTreeDoesNot(self):
+        # Only the repos the plans build from can have moved between
+        # these runs, the local tree can not tell so both runs check
+        self.assertFalse(self.finish())
+        self.assertFalse(self.finish())
+
+
+if __name__ == '__main__':
+    unittest.main()